@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+"""
+Benchmark delle query sulle tabelle del bot.
+
+Crea uno schema temporaneo, applica le migrazioni di bot.py, fa crescere la
+tabella bookings a step e per ogni step esegue EXPLAIN ANALYZE sulle query
+calde (scheduler e /lista) usando le stesse funzioni del bot. Segnala se un
+piano smette di usare l'indice atteso (vedi REQUIRED_NODES).
+
+Alla fine confronta la scrittura degli esiti di prenotazione una riga per
+volta (UPDATE + commit ciascuno) con quella a batch di check_and_book
+(BENCH_WRITES esiti, default 200).
+
+Uso:
+    BENCH_DATABASE_URL=postgresql://... python benchmark_db.py [righe ...]
+
+BENCH_DATABASE_URL è obbligatoria (nessun fallback su DATABASE_URL). Lo
+schema temporaneo viene sempre eliminato alla fine.
+"""
+
+import os
+import sys
+import json
+import time
+from datetime import datetime
+
+import psycopg2
+import pytz
+
+import bot
+
+DEFAULT_STEPS = [1_000, 10_000, 100_000, 500_000]
+BENCH_USERS = 200
+BENCH_USER = '1000042'
+BENCH_OWNER = 'benchmark'
+
+# Nodo di piano (con indice) richiesto per ogni query calda. /lista deve restare
+# un Index Only Scan sull'indice di copertura. Il claim dello scheduler blocca le
+# righe (FOR UPDATE SKIP LOCKED) e per farlo deve leggere la tupla nella heap,
+# quindi Postgres non può usare un Index Only Scan: lì si richiede un Index Scan
+# sull'indice parziale dei pending.
+REQUIRED_NODES = {
+    'scheduler': 'Index Scan (idx_bookings_pending_due)',
+    'lista': 'Index Only Scan (idx_bookings_user_start)',
+}
+
+
+class ExplainCursor:
+    """Cursore che esegue EXPLAIN al posto della query e ne conserva il piano"""
+
+    def __init__(self, cur):
+        self.cur = cur
+        self.plan = None
+
+    def execute(self, sql, params=None):
+        self.cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, params)
+        self.plan = self.cur.fetchone()[0][0]
+
+    def fetchall(self):
+        return []
+
+    def fetchone(self):
+        return None
+
+
+def plan_nodes(node):
+    """Ritorna i tipi di nodo del piano (con l'indice usato, se c'è)"""
+    label = node['Node Type']
+    if 'Index Name' in node:
+        label += f" ({node['Index Name']})"
+    nodes = [label]
+    for child in node.get('Plans', []):
+        nodes.extend(plan_nodes(child))
+    return nodes
+
+
+def grow_table(cur, total):
+    """Porta bookings a `total` righe: storico completato più pochi pending"""
+    cur.execute("SELECT COUNT(*) FROM bookings")
+    current = cur.fetchone()[0]
+    missing = total - current
+    if missing <= 0:
+        return
+    cur.execute(
+        """
+        INSERT INTO bookings (user_id, class_name, class_date, class_time, class_start_utc,
+                              booking_date, status, course_appointment_id)
+        SELECT
+            CASE WHEN g %% 50 = 0 THEN %s ELSE (1000000 + g %% %s)::text END,
+            (ARRAY['Pilates', 'Yoga', 'Spinning', 'Total Body', 'GAG'])[1 + g %% 5],
+            d,
+            t,
+            (d + t::time) AT TIME ZONE 'Europe/Rome',
+            (d + t::time) AT TIME ZONE 'Europe/Rome' - INTERVAL '72 hours',
+            CASE WHEN g %% 100 = 0 THEN 'pending' ELSE 'completed' END,
+            100000 + g
+        FROM generate_series(%s, %s) AS g,
+             LATERAL (SELECT (CURRENT_DATE - 720 + g %% 760)::date,
+                             lpad((8 + g %% 13)::text, 2, '0') || ':' || (ARRAY['00', '30'])[1 + g %% 2]
+                     ) AS s(d, t)
+        """,
+        (BENCH_USER, BENCH_USERS, current + 1, total),
+    )
+
+
+def explain(cur, query, *args):
+    explain_cur = ExplainCursor(cur)
+    query(explain_cur, *args)
+    plan = explain_cur.plan
+    return plan_nodes(plan['Plan']), plan['Execution Time']
+
+
+def claim_for_writes(cur, booking_ids):
+    """Porta le righe in_progress con lease del benchmark, come dopo un claim"""
+    cur.execute(
+        """
+        UPDATE bookings
+        SET status = 'in_progress', lease_owner = %s, lease_expires_at = NOW() + INTERVAL '1 hour'
+        WHERE id = ANY(%s)
+        """,
+        (BENCH_OWNER, booking_ids)
+    )
+
+
+def bench_writes(conn, cur, count):
+    """Tempo per scrivere `count` esiti: per riga contro a batch. Ritorna i ms"""
+    cur.execute("SELECT id FROM bookings ORDER BY id LIMIT %s", (count,))
+    booking_ids = [row[0] for row in cur.fetchall()]
+    outcomes = [
+        bot.BookingOutcome(booking_id, 'completed', 900000 + booking_id, 'completed', 250.0, 3.0, [None])
+        for booking_id in booking_ids
+    ]
+    timings = {}
+
+    claim_for_writes(cur, booking_ids)
+    conn.commit()
+    started = time.perf_counter()
+    for outcome in outcomes:
+        bot.update_booking_outcome(cur, outcome, BENCH_OWNER)
+        conn.commit()
+    timings['per_row'] = (time.perf_counter() - started) * 1000
+
+    claim_for_writes(cur, booking_ids)
+    conn.commit()
+    batch_size = max(1, bot.BOOKING_WRITE_BATCH_SIZE)
+    started = time.perf_counter()
+    for start in range(0, len(outcomes), batch_size):
+        bot.update_booking_outcomes(cur, outcomes[start:start + batch_size], BENCH_OWNER)
+        conn.commit()
+    timings['batched'] = (time.perf_counter() - started) * 1000
+    return len(outcomes), batch_size, timings
+
+
+def main():
+    # Niente fallback su DATABASE_URL: il benchmark non deve girare per sbaglio sul DB del bot
+    dsn = os.getenv('BENCH_DATABASE_URL')
+    if not dsn:
+        sys.exit("❌ Imposta BENCH_DATABASE_URL")
+    steps = [int(arg) for arg in sys.argv[1:]] or DEFAULT_STEPS
+    schema = f"bench_{os.getpid()}"
+
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor()
+    cur.execute(f"CREATE SCHEMA {schema}")
+    cur.execute(f"SET search_path TO {schema}")
+    conn.commit()
+
+    queries = [
+        ('scheduler', bot.claim_due_bookings,
+         lambda: (datetime.now(pytz.UTC), 'benchmark', bot.BOOKING_LEASE_SECONDS, [], bot.BOOKING_CONCURRENCY)),
+        ('lista', bot.select_user_bookings, lambda: (BENCH_USER, bot.LISTA_PAGE_SIZE, 0)),
+    ]
+    report = []
+    failures = 0
+    try:
+        bot.apply_migrations(conn)
+        for total in steps:
+            grow_table(cur, total)
+            conn.commit()
+            conn.autocommit = True
+            cur.execute("VACUUM ANALYZE bookings")
+            conn.autocommit = False
+
+            for name, query, args in queries:
+                nodes, elapsed = explain(cur, query, *args())
+                conn.rollback()
+                indexed = REQUIRED_NODES[name] in nodes
+                seq_scan = any(node.startswith('Seq Scan') for node in nodes)
+                ok = indexed and not seq_scan
+                failures += 0 if ok else 1
+                report.append({
+                    'rows': total,
+                    'query': name,
+                    'execution_ms': round(elapsed, 3),
+                    'plan': nodes,
+                    'ok': ok,
+                })
+                status = '✅' if ok else '❌'
+                print(f"{status} {total:>8} righe  {name:<10} {elapsed:8.3f} ms  {' → '.join(nodes)}")
+
+        written, batch_size, timings = bench_writes(conn, cur, int(os.getenv('BENCH_WRITES', '200')))
+        speedup = timings['per_row'] / timings['batched'] if timings['batched'] else 0
+        report.append({'query': 'outcome_writes', 'rows': written, 'batch_size': batch_size, **timings})
+        print(f"✍️ {written} esiti: per riga {timings['per_row']:.1f} ms, "
+              f"a batch da {batch_size} {timings['batched']:.1f} ms (x{speedup:.1f})")
+    finally:
+        conn.rollback()
+        cur.execute(f"DROP SCHEMA {schema} CASCADE")
+        conn.commit()
+        conn.close()
+
+    if os.getenv('BENCH_JSON'):
+        print(json.dumps(report, indent=2))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,21 @@
 import os
+import asyncio
+import json
 import logging
 from datetime import datetime, timedelta
+from collections import OrderedDict, deque, namedtuple
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
 import psycopg2
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.jobstores.base import JobLookupError
 import requests
+import httpx
 import threading
+import socket
+import select
+from concurrent.futures import ThreadPoolExecutor
+import time
 from http.server import HTTPServer, BaseHTTPRequestHandler
 import pytz
 
@@ -27,67 +36,1085 @@ EASYFIT_PASSWORD = os.getenv('EASYFIT_PASSWORD')
 EASYFIT_BASE_URL = "https://app-easyfitpalestre.it"
 ORGANIZATION_UNIT_ID = "1216915380"
 
+# Durata massima della sessione EasyFit condivisa (secondi) prima di un nuovo login
+EASYFIT_SESSION_MAX_AGE = int(os.getenv('EASYFIT_SESSION_MAX_AGE', '1800'))
+# Connessioni massime del client EasyFit (handler e prenotazioni) e connessioni
+# da pre-aprire prima di uno sparo
+EASYFIT_ASYNC_MAX_CONNECTIONS = int(os.getenv('EASYFIT_ASYNC_MAX_CONNECTIONS', '10'))
+EASYFIT_PREWARM_CONNECTIONS = int(os.getenv('EASYFIT_PREWARM_CONNECTIONS', '4'))
+# Secondi per cui una connessione keep-alive inattiva resta aperta: deve superare
+# di molto BOOKING_PREWARM_LEAD, o le connessioni pre-aperte scadono prima dello sparo
+EASYFIT_KEEPALIVE_EXPIRY = float(os.getenv('EASYFIT_KEEPALIVE_EXPIRY', '60'))
+
+# Cache calendario: validità (secondi) e numero massimo di giorni in memoria
+CALENDAR_CACHE_TTL = int(os.getenv('CALENDAR_CACHE_TTL', '120'))
+CALENDAR_CACHE_MAX_DAYS = int(os.getenv('CALENDAR_CACHE_MAX_DAYS', '31'))
+
+# /lista: prenotazioni per pagina e lunghezza massima di un messaggio Telegram
+LISTA_PAGE_SIZE = int(os.getenv('LISTA_PAGE_SIZE', '10'))
+# /storico: lezioni passate mostrate
+STORICO_LIMIT = int(os.getenv('STORICO_LIMIT', '20'))
+TELEGRAM_MESSAGE_LIMIT = 4096
+
 # Timezone Italia
 ROME_TZ = pytz.timezone('Europe/Rome')
 
+# Ore di silenzio opzionali (ora italiana, "inizio-fine", es. "1-6" o "23-6"): le
+# prenotazioni che scadono dentro la fascia partono alla sua fine. Vuoto = sempre attivo
+QUIET_HOURS = os.getenv('QUIET_HOURS', '')
+
+
+def parse_quiet_hours(value):
+    """(inizio, fine) da "inizio-fine", oppure (None, None) se vuoto o non valido"""
+    if not value:
+        return None, None
+    try:
+        start, end = (int(hour) for hour in value.split('-'))
+    except ValueError:
+        start = end = None
+    if start is None or not (0 <= start <= 23 and 0 <= end <= 23) or start == end:
+        logger.warning(f"⚠️ QUIET_HOURS non valido ({value!r}, atteso es. \"1-6\"): ore di silenzio disattivate")
+        return None, None
+    return start, end
+
+
+QUIET_HOURS_START, QUIET_HOURS_END = parse_quiet_hours(QUIET_HOURS)
+if QUIET_HOURS_START is None:
+    QUIET_HOURS = ''
+
+# Anticipo (secondi) con cui parte il timer di una prenotazione per login e calendario
+BOOKING_PREP_LEAD = int(os.getenv('BOOKING_PREP_LEAD', '15'))
+# Anticipo (secondi) con cui si ricontrolla l'ID lezione pre-risolto
+BOOKING_PRERESOLVE_LEAD = int(os.getenv('BOOKING_PRERESOLVE_LEAD', '300'))
+# Anticipo (secondi) con cui si pre-aprono le connessioni verso EasyFit
+BOOKING_PREWARM_LEAD = int(os.getenv('BOOKING_PREWARM_LEAD', '5'))
+# Prenotazioni eseguite in parallelo al massimo
+BOOKING_CONCURRENCY = int(os.getenv('BOOKING_CONCURRENCY', '8'))
+
+# Burst all'apertura: per quanti secondi e ogni quanti ms ritentare se EasyFit
+# risponde che la lezione non è ancora prenotabile
+BOOKING_BURST_SECONDS = float(os.getenv('BOOKING_BURST_SECONDS', '20'))
+BOOKING_BURST_INTERVAL_MS = int(os.getenv('BOOKING_BURST_INTERVAL_MS', '200'))
+
+# Claim delle prenotazioni tra più istanze: identità di questa istanza e durata
+# del lease (secondi) oltre la quale una prenotazione in_progress torna riprendibile
+INSTANCE_ID = os.getenv('INSTANCE_ID') or f"{socket.gethostname()}-{os.getpid()}"
+BOOKING_LEASE_SECONDS = int(os.getenv('BOOKING_LEASE_SECONDS', '120'))
+
+# Frammenti di errorCode/messaggio EasyFit usati per classificare i rifiuti
+BOOKING_NOT_OPEN_MARKERS = ('not_yet', 'not yet', 'too_early', 'too early', 'not_open', 'booking_period',
+                            'bookable_from', 'not_bookable_yet', 'non ancora')
+BOOKING_FULL_MARKERS = ('full', 'piena', 'no_free', 'no free', 'capacity', 'max_participants')
+# errorCode EasyFit (esatti, separati da virgola) che indicano una prenotazione già
+# esistente: solo questi contano come prenotazione riuscita
+BOOKING_ALREADY_ERROR_CODES = {
+    code.strip().lower()
+    for code in os.getenv('BOOKING_ALREADY_ERROR_CODES', 'ALREADY_BOOKED,CUSTOMER_ALREADY_BOOKED').split(',')
+    if code.strip()
+}
+
 # Connection pool per gestire meglio le connessioni Supabase
 import psycopg2.pool
+import psycopg2.extensions
+import psycopg2.extras
+
+# Dimensione del pool DB (handler, prenotazioni e job) e attesa massima (secondi) di una connessione
+# libera quando è esaurito (0 = errore immediato)
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '1'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', '5'))
+DB_POOL_WAIT_TIMEOUT = float(os.getenv('DB_POOL_WAIT_TIMEOUT', '5'))
+# Età massima di una connessione (secondi) e inattività oltre la quale va validata
+DB_POOL_MAX_AGE = int(os.getenv('DB_POOL_MAX_AGE', '1800'))
+DB_POOL_VALIDATE_IDLE = int(os.getenv('DB_POOL_VALIDATE_IDLE', '60'))
+
+# Timeout (secondi) di una query eseguita dall'event loop
+ASYNC_DB_TIMEOUT = float(os.getenv('ASYNC_DB_TIMEOUT', '10'))
+# Thread dell'executor DB oltre a DB_POOL_MAX: le query in più attendono una
+# connessione libera nel pool (fino a DB_POOL_WAIT_TIMEOUT) invece che in coda all'executor
+DB_EXECUTOR_EXTRA_WORKERS = int(os.getenv('DB_EXECUTOR_EXTRA_WORKERS', '3'))
+
+# Esiti di prenotazione scritti insieme in check_and_book: dimensione del batch e
+# se scrivere subito un batch appena contiene un ID prenotazione EasyFit confermato
+BOOKING_WRITE_BATCH_SIZE = int(os.getenv('BOOKING_WRITE_BATCH_SIZE', '8'))
+BOOKING_FLUSH_ON_CONFIRM = os.getenv('BOOKING_FLUSH_ON_CONFIRM', '1') == '1'
+# Nuovi tentativi di scrittura per gli esiti già confermati su EasyFit (attesa
+# 1, 2, 4... secondi): se falliscono tutti la riga resta in_progress, mai pending
+BOOKING_CONFIRMED_WRITE_RETRIES = int(os.getenv('BOOKING_CONFIRMED_WRITE_RETRIES', '3'))
+
+# LISTEN/NOTIFY sulle modifiche a bookings: serve una connessione diretta o in
+# session mode (il pooler in transaction mode non inoltra le notifiche)
+DATABASE_LISTEN_URL = os.getenv('DATABASE_LISTEN_URL') or DATABASE_URL
+# Porta del pooler Supabase in transaction mode e schema delle tabelle del bot
+SUPABASE_TRANSACTION_POOLER_PORT = '6543'
+BOOKINGS_SCHEMA = os.getenv('BOOKINGS_SCHEMA', 'public')
+
+# Controllo prenotazioni a scadenza: si risveglia BOOKING_SWEEP_GRACE secondi dopo
+# la prossima prenotazione, ritenta dopo BOOKING_SWEEP_RETRY secondi (errori o righe
+# scadute) e dorme al massimo BOOKING_SWEEP_MAX_SLEEP, o BOOKING_SWEEP_POLL quando
+# LISTEN non è attivo (le prenotazioni inserite da questa istanza armano comunque il loro timer)
+BOOKING_SWEEP_GRACE = int(os.getenv('BOOKING_SWEEP_GRACE', '30'))
+BOOKING_SWEEP_RETRY = int(os.getenv('BOOKING_SWEEP_RETRY', '60'))
+BOOKING_SWEEP_POLL = int(os.getenv('BOOKING_SWEEP_POLL', '600'))
+BOOKING_SWEEP_MAX_SLEEP = int(os.getenv('BOOKING_SWEEP_MAX_SLEEP', '21600'))
+
+# Archiviazione in bookings_history: ore dopo l'inizio lezione, righe per
+# transazione e batch massimi per esecuzione del job notturno
+BOOKING_ARCHIVE_AFTER_HOURS = int(os.getenv('BOOKING_ARCHIVE_AFTER_HOURS', '24'))
+BOOKING_ARCHIVE_BATCH_SIZE = int(os.getenv('BOOKING_ARCHIVE_BATCH_SIZE', '500'))
+BOOKING_ARCHIVE_MAX_BATCHES = int(os.getenv('BOOKING_ARCHIVE_MAX_BATCHES', '50'))
 from threading import Lock
 
-# Pool globale di connessioni
-db_pool = None
-pool_lock = Lock()
+class ManagedConnectionPool:
+    """
+    ThreadedConnectionPool con validazione economica: niente SELECT 1 a ogni
+    checkout, solo dopo un periodo di inattività o dopo un errore. Le
+    connessioni più vecchie di max_age vengono riciclate.
+    Quando tutte le connessioni sono in uso attende fino a wait_timeout
+    secondi che se ne liberi una (0 = PoolError immediato) e tiene le
+    metriche di utilizzo: connessioni in uso, attese, esaurimenti e
+    istogramma della durata dei checkout.
+    """
 
-def init_db_pool():
-    """Inizializza il connection pool"""
-    global db_pool
-    with pool_lock:
-        if db_pool is None:
-            try:
-                db_pool = psycopg2.pool.ThreadedConnectionPool(
-                    minconn=1,
-                    maxconn=5,
-                    dsn=DATABASE_URL,
-                    sslmode='require',
-                    connect_timeout=10
-                )
-                logger.info("💾 Connection pool inizializzato")
-            except Exception as e:
-                logger.error(f"❌ Errore init pool: {e}")
-                db_pool = None
-
-def get_db_connection(max_retries=3):
-    import time
-    if db_pool is None:
-        init_db_pool()
-    for attempt in range(max_retries):
+    # Limiti superiori (ms) dei bucket dell'istogramma di durata dei checkout
+    HOLD_BUCKETS_MS = (10, 50, 100, 500, 1000, 5000)
+
+    def __init__(self, minconn, maxconn, dsn, max_age=DB_POOL_MAX_AGE, validate_idle=DB_POOL_VALIDATE_IDLE,
+                 wait_timeout=DB_POOL_WAIT_TIMEOUT, **kwargs):
+        self.maxconn = maxconn
+        self.max_age = max_age
+        self.validate_idle = validate_idle
+        self.wait_timeout = wait_timeout
+        self._pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn=dsn, **kwargs)
+        self._meta = {}  # id(conn) -> [created_at, last_used, suspect]
+        self._lock = Lock()
+        self._slots = threading.Condition()
+        self._held = {}  # id(conn) -> istante del checkout
+        self.in_use = 0
+        self.peak_in_use = 0
+        self.checkout_ms = deque(maxlen=200)
+        self.wait_ms = deque(maxlen=200)
+        self.hold_histogram = [0] * (len(self.HOLD_BUCKETS_MS) + 1)
+        self.exhaustions = 0
+        self.wait_timeouts = 0
+        self.validations = 0
+        self.recycled = 0
+        self.reconnects = 0
+
+    def _meta_for(self, conn):
+        with self._lock:
+            meta = self._meta.get(id(conn))
+            if meta is None:
+                now = time.monotonic()
+                meta = self._meta[id(conn)] = [now, now, False]
+            return meta
+
+    def _acquire_slot(self):
+        """Riserva una delle maxconn connessioni, attendendo se sono tutte in uso"""
+        with self._slots:
+            if self.in_use >= self.maxconn:
+                self.exhaustions += 1
+                logger.warning(f"⚠️ Pool DB esaurito ({self.in_use}/{self.maxconn} in uso)")
+                started = time.monotonic()
+                if not self.wait_timeout or not self._slots.wait_for(
+                    lambda: self.in_use < self.maxconn, timeout=self.wait_timeout
+                ):
+                    self.wait_timeouts += 1
+                    raise psycopg2.pool.PoolError(
+                        f"connection pool exhausted ({self.maxconn} in uso, attesa {self.wait_timeout}s)"
+                    )
+                self.wait_ms.append((time.monotonic() - started) * 1000)
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+    def _release_slot(self):
+        with self._slots:
+            self.in_use -= 1
+            self._slots.notify()
+
+    def _checkin(self, conn):
+        """Chiude il checkout di una connessione: registra la durata e libera il posto"""
+        with self._lock:
+            checked_out_at = self._held.pop(id(conn), None)
+        if checked_out_at is None:
+            return
+        held_ms = (time.monotonic() - checked_out_at) * 1000
+        bucket = next(
+            (index for index, limit in enumerate(self.HOLD_BUCKETS_MS) if held_ms <= limit),
+            len(self.HOLD_BUCKETS_MS)
+        )
+        with self._lock:
+            self.hold_histogram[bucket] += 1
+        self._release_slot()
+
+    def _drop(self, conn):
+        with self._lock:
+            self._meta.pop(id(conn), None)
+        try:
+            self._pool.putconn(conn, close=True)
+        except Exception as e:
+            logger.warning(f"⚠️ Errore chiusura connessione: {e}")
+
+    def discard(self, conn):
+        """Chiude una connessione e la toglie dal pool"""
+        self._drop(conn)
+        self._checkin(conn)
+
+    def mark_suspect(self, conn):
+        """La connessione verrà validata al prossimo checkout"""
+        self._meta_for(conn)[2] = True
+
+    def _validate(self, conn):
+        self.validations += 1
         try:
-            conn = db_pool.getconn()
             cur = conn.cursor()
             cur.execute('SELECT 1')
             cur.close()
-            return conn
+            conn.rollback()
+            return True
         except Exception as e:
-            if attempt < max_retries - 1:
-                wait_time = (attempt + 1) * 2
-                logger.warning(f"⚠️ Errore DB (tentativo {attempt + 1}/{max_retries}): {str(e)[:100]}")
-                logger.info(f"⏳ Riprovo tra {wait_time}s...")
+            logger.warning(f"⚠️ Connessione DB non valida: {str(e)[:100]}")
+            return False
+
+    def getconn(self):
+        started = time.monotonic()
+        self._acquire_slot()
+        try:
+            conn = self._getconn()
+        except Exception:
+            self._release_slot()
+            raise
+        with self._lock:
+            self._held[id(conn)] = time.monotonic()
+        self.checkout_ms.append((time.monotonic() - started) * 1000)
+        return conn
+
+    def _getconn(self):
+        last_error = None
+        for _ in range(self.maxconn + 1):
+            try:
+                conn = self._pool.getconn()
+            except psycopg2.OperationalError as e:
+                last_error = e
+                logger.warning(f"⚠️ Errore apertura connessione DB: {str(e)[:100]}")
+                continue
+            created_at, last_used, suspect = self._meta_for(conn)
+            now = time.monotonic()
+            if conn.closed:
+                self._drop(conn)
+                continue
+            if self.max_age and now - created_at > self.max_age:
+                self.recycled += 1
+                self._drop(conn)
+                continue
+            if (suspect or now - last_used > self.validate_idle) and not self._validate(conn):
+                self._drop(conn)
+                continue
+            self._meta_for(conn)[2] = False
+            return conn
+        raise last_error or psycopg2.OperationalError("nessuna connessione DB valida disponibile")
+
+    def putconn(self, conn):
+        try:
+            if conn.closed:
+                self._drop(conn)
+                return
+            if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
                 try:
-                    if 'conn' in locals():
-                        db_pool.putconn(conn, close=True)
-                except:
-                    pass
-                time.sleep(wait_time)
-            else:
-                logger.error(f"❌ Connessione DB fallita dopo {max_retries} tentativi")
-                raise
+                    conn.rollback()
+                except Exception:
+                    self._drop(conn)
+                    return
+            self._meta_for(conn)[1] = time.monotonic()
+            self._pool.putconn(conn)
+        finally:
+            self._checkin(conn)
+
+    def run(self, operation, commit=False):
+        """
+        Esegue operation(cur) su una connessione del pool e ne ritorna il risultato.
+        Se la connessione cade prima del COMMIT la scarta e riprova una volta con
+        una connessione nuova: la transazione interrotta non è stata applicata.
+        Se cade durante il COMMIT non riprova, perché il server potrebbe averlo
+        già eseguito (es. insert_booking inserirebbe una seconda riga).
+        Le operazioni che fanno COMMIT da sole (apply_migrations) devono essere
+        idempotenti.
+        """
+        for attempt in range(2):
+            conn = self.getconn()
+            committing = False
+            try:
+                cur = conn.cursor()
+                result = operation(cur)
+                if commit:
+                    committing = True
+                    conn.commit()
+                cur.close()
+                return result
+            except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+                self.discard(conn)
+                conn = None
+                if attempt or committing:
+                    raise
+                self.reconnects += 1
+                logger.warning(f"⚠️ Connessione DB caduta, riprovo: {str(e)[:100]}")
+            finally:
+                if conn is not None:
+                    self.putconn(conn)
+
+    def closeall(self):
+        self._pool.closeall()
+
+    def metrics(self):
+        checkouts = list(self.checkout_ms)
+        waits = list(self.wait_ms)
+        bucket_names = [f"le_{limit}" for limit in self.HOLD_BUCKETS_MS] + [f"gt_{self.HOLD_BUCKETS_MS[-1]}"]
+        return {
+            'max': self.maxconn,
+            'in_use': self.in_use,
+            'peak_in_use': self.peak_in_use,
+            'checkouts': len(checkouts),
+            'checkout_ms_avg': round(sum(checkouts) / len(checkouts), 2) if checkouts else None,
+            'checkout_ms_max': round(max(checkouts), 2) if checkouts else None,
+            'hold_ms_histogram': dict(zip(bucket_names, self.hold_histogram)),
+            'exhaustions': self.exhaustions,
+            'waits': len(waits),
+            'wait_ms_max': round(max(waits), 2) if waits else None,
+            'wait_timeouts': self.wait_timeouts,
+            'validations': self.validations,
+            'recycled': self.recycled,
+            'reconnects': self.reconnects
+        }
+
+
+# =============================================================================
+# DATABASE MIGRATIONS
+# =============================================================================
+# Migrazioni numerate applicate all'avvio, in ordine, una transazione ciascuna.
+# Non modificare quelle già rilasciate: aggiungerne sempre una nuova in coda.
+
+MIGRATIONS = [
+    (1, 'create_bookings', """
+        CREATE TABLE IF NOT EXISTS bookings (
+            id SERIAL PRIMARY KEY,
+            user_id VARCHAR(50) NOT NULL,
+            class_name VARCHAR(100) NOT NULL,
+            class_date DATE NOT NULL,
+            class_time VARCHAR(5) NOT NULL,
+            booking_date TIMESTAMPTZ NOT NULL,
+            status VARCHAR(20) DEFAULT 'pending',
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        );
+        ALTER TABLE bookings ADD COLUMN IF NOT EXISTS easyfit_booking_id BIGINT;
+    """),
+    (2, 'bookings_course_appointment_id', """
+        ALTER TABLE bookings ADD COLUMN IF NOT EXISTS course_appointment_id BIGINT;
+    """),
+    (3, 'bookings_hot_query_indexes', """
+        -- check_and_book: pending già scaduti in ordine di booking_date
+        CREATE INDEX IF NOT EXISTS idx_bookings_pending_due
+            ON bookings (booking_date)
+            INCLUDE (id, user_id, class_name, class_date, class_time, course_appointment_id)
+            WHERE status = 'pending';
+        -- /lista: prenotazioni di un utente in ordine di lezione
+        CREATE INDEX IF NOT EXISTS idx_bookings_user_class
+            ON bookings (user_id, class_date, class_time)
+            INCLUDE (id, class_name, booking_date, status);
+    """),
+    (4, 'bookings_class_start_utc', """
+        -- Inizio lezione normalizzato: data/ora EasyFit sono ora italiana
+        ALTER TABLE bookings ADD COLUMN IF NOT EXISTS class_start_utc TIMESTAMPTZ;
+        UPDATE bookings
+        SET class_start_utc = (class_date + class_time::time) AT TIME ZONE 'Europe/Rome'
+        WHERE class_start_utc IS NULL;
+        -- /lista: prenotazioni future di un utente come range scan
+        CREATE INDEX IF NOT EXISTS idx_bookings_user_start
+            ON bookings (user_id, class_start_utc)
+            INCLUDE (id, class_name, booking_date, status);
+        DROP INDEX IF EXISTS idx_bookings_user_class;
+    """),
+    (5, 'bookings_claim_lease', """
+        -- Claim: status 'in_progress' con proprietario e scadenza del lease
+        ALTER TABLE bookings ADD COLUMN IF NOT EXISTS lease_owner VARCHAR(100);
+        ALTER TABLE bookings ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ;
+        CREATE INDEX IF NOT EXISTS idx_bookings_lease
+            ON bookings (lease_expires_at)
+            WHERE status = 'in_progress';
+    """),
+    (6, 'bookings_outcome_details', """
+        ALTER TABLE bookings ADD COLUMN IF NOT EXISTS processed_at TIMESTAMPTZ;
+        ALTER TABLE bookings ADD COLUMN IF NOT EXISTS error_code VARCHAR(50);
+        ALTER TABLE bookings ADD COLUMN IF NOT EXISTS fire_offset_ms REAL;
+        ALTER TABLE bookings ADD COLUMN IF NOT EXISTS attempts INTEGER;
+    """),
+    (7, 'bookings_changed_notify', """
+        CREATE OR REPLACE FUNCTION notify_bookings_changed() RETURNS trigger AS $$
+        DECLARE
+            old_status TEXT := NULL;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('bookings_changed', json_build_object(
+                    'op', TG_OP, 'id', OLD.id, 'old_status', OLD.status
+                )::text);
+                RETURN OLD;
+            END IF;
+            IF TG_OP = 'UPDATE' THEN
+                old_status := OLD.status;
+            END IF;
+            PERFORM pg_notify('bookings_changed', json_build_object(
+                'op', TG_OP, 'id', NEW.id, 'status', NEW.status,
+                'old_status', old_status, 'booking_date', NEW.booking_date
+            )::text);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        DROP TRIGGER IF EXISTS bookings_changed ON bookings;
+        CREATE TRIGGER bookings_changed
+            AFTER INSERT OR DELETE OR UPDATE OF status, booking_date ON bookings
+            FOR EACH ROW EXECUTE FUNCTION notify_bookings_changed();
+    """),
+    (8, 'bookings_history', """
+        -- Archivio delle lezioni passate, una partizione per mese (create dal job)
+        CREATE TABLE IF NOT EXISTS bookings_history (
+            id INTEGER NOT NULL,
+            user_id VARCHAR(50) NOT NULL,
+            class_name VARCHAR(100) NOT NULL,
+            class_date DATE NOT NULL,
+            class_time VARCHAR(5) NOT NULL,
+            class_start_utc TIMESTAMPTZ NOT NULL,
+            booking_date TIMESTAMPTZ NOT NULL,
+            status VARCHAR(20),
+            created_at TIMESTAMPTZ,
+            easyfit_booking_id BIGINT,
+            course_appointment_id BIGINT,
+            processed_at TIMESTAMPTZ,
+            error_code VARCHAR(50),
+            fire_offset_ms REAL,
+            attempts INTEGER,
+            archived_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            PRIMARY KEY (id, class_start_utc)
+        ) PARTITION BY RANGE (class_start_utc);
+        CREATE INDEX IF NOT EXISTS idx_bookings_history_user_start
+            ON bookings_history (user_id, class_start_utc);
+        -- Selezione delle righe da archiviare
+        CREATE INDEX IF NOT EXISTS idx_bookings_class_start
+            ON bookings (class_start_utc);
+    """),
+    (9, 'scheduler_jobs', """
+        -- Job store persistente dei timer di prenotazione: una riga per job
+        -- (job_id univoco, lo stesso id del job in memoria) con l'orario di sparo
+        -- calcolato dal bot, ore di silenzio comprese. La scrive il bot nella
+        -- stessa transazione della prenotazione; sparisce con la prenotazione
+        -- (cancellazione o archivio) o quando ne salva l'esito
+        CREATE TABLE IF NOT EXISTS scheduler_jobs (
+            job_id TEXT PRIMARY KEY,
+            kind VARCHAR(20) NOT NULL,
+            booking_id INTEGER NOT NULL REFERENCES bookings (id) ON DELETE CASCADE,
+            run_at TIMESTAMPTZ NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        -- Ricostruzione all'avvio: solo i job futuri, in ordine di esecuzione
+        CREATE INDEX IF NOT EXISTS idx_scheduler_jobs_run_at
+            ON scheduler_jobs (run_at) INCLUDE (kind, booking_id);
+        -- ON DELETE CASCADE e pulizia dopo l'esito
+        CREATE INDEX IF NOT EXISTS idx_scheduler_jobs_booking
+            ON scheduler_jobs (booking_id);
+    """),
+    (10, 'bookings_changed_notify_schema', """
+        -- I canali NOTIFY valgono per tutto il database: lo schema nel payload
+        -- permette di ignorare le modifiche di altri schemi (es. benchmark_db.py)
+        CREATE OR REPLACE FUNCTION notify_bookings_changed() RETURNS trigger AS $$
+        DECLARE
+            old_status TEXT := NULL;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                PERFORM pg_notify('bookings_changed', json_build_object(
+                    'op', TG_OP, 'schema', TG_TABLE_SCHEMA, 'id', OLD.id, 'old_status', OLD.status
+                )::text);
+                RETURN OLD;
+            END IF;
+            IF TG_OP = 'UPDATE' THEN
+                old_status := OLD.status;
+            END IF;
+            PERFORM pg_notify('bookings_changed', json_build_object(
+                'op', TG_OP, 'schema', TG_TABLE_SCHEMA, 'id', NEW.id, 'status', NEW.status,
+                'old_status', old_status, 'booking_date', NEW.booking_date
+            )::text);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+    """),
+]
+
+# Chiave dell'advisory lock che serializza le migrazioni tra più istanze
+MIGRATIONS_LOCK_ID = 0x45465942  # "EFYB"
+
+
+def apply_migrations(conn):
+    """
+    Applica sulla connessione le migrazioni non ancora registrate in
+    schema_migrations. Ogni migrazione gira in una transazione con un
+    advisory lock di transazione, compatibile con il pooler di Supabase.
+    Ritorna le versioni applicate.
+    """
+    cur = conn.cursor()
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        )
+        """
+    )
+    conn.commit()
+    applied = []
+    try:
+        for version, name, sql in MIGRATIONS:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (MIGRATIONS_LOCK_ID,))
+            cur.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+            if cur.fetchone():
+                conn.rollback()
+                continue
+            logger.info(f"🗄️ Migrazione {version:03d} {name}...")
+            cur.execute(sql)
+            cur.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+            conn.commit()
+            applied.append(version)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return applied
+
+
+# Timeout (secondi) delle migrazioni all'avvio: un backfill può durare più di una query
+MIGRATIONS_TIMEOUT = 300
 
-def release_db_connection(conn):
+
+async def run_migrations():
+    """
+    Porta lo schema all'ultima versione (chiamata all'avvio). Se una
+    migrazione fallisce rilancia l'errore: il bot non deve partire su uno
+    schema a metà.
+    """
     try:
-        if db_pool and conn:
-            db_pool.putconn(conn)
+        applied = await async_db.run(lambda cur: apply_migrations(cur.connection), timeout=MIGRATIONS_TIMEOUT)
+        # L'orario di sparo dipende da QUIET_HOURS, quindi il job store lo riempie il bot e
+        # non la migrazione 9: qui i job mancanti (prima esecuzione o backfill interrotto)
+        backfilled = await async_db.run(backfill_booking_jobs, commit=True, timeout=MIGRATIONS_TIMEOUT)
     except Exception as e:
-        logger.warning(f"⚠️ Errore rilascio connessione: {e}")
+        logger.error(f"❌ Errore migrazioni DB, avvio interrotto: {e}")
+        raise
+    if backfilled:
+        logger.info(f"⏲️ Job store: {backfilled} timer di prenotazione creati")
+    if applied:
+        logger.info(f"✅ Migrazioni applicate: {', '.join(str(v) for v in applied)}")
+    else:
+        logger.info("✅ Schema DB aggiornato")
+
+
+# =============================================================================
+# BOOKINGS QUERIES
+# =============================================================================
+# Query sulla tabella bookings: ricevono un cursore, così le usano sia lo
+# scheduler sia gli handler (tramite async_db) sia benchmark_db.py con lo stesso SQL.
+
+def select_user_bookings(cur, user_id, limit, offset):
+    """
+    Una pagina delle prenotazioni future dell'utente, già raggruppate per
+    stato (programmate, prenotate, lista d'attesa) e ordinate per lezione.
+    L'ultima colonna è il totale delle righe, per la paginazione.
+    """
+    cur.execute(
+        """
+        SELECT id, class_name, class_start_utc, booking_date,
+               CASE WHEN status = 'in_progress' THEN 'pending' ELSE status END,
+               COUNT(*) OVER () AS total
+        FROM bookings
+        WHERE user_id = %s
+        AND class_start_utc > NOW()
+        AND status IN ('pending', 'in_progress', 'completed', 'waitlisted')
+        ORDER BY CASE status
+                     WHEN 'pending' THEN 0
+                     WHEN 'in_progress' THEN 0
+                     WHEN 'completed' THEN 1
+                     ELSE 2
+                 END,
+                 class_start_utc, id
+        LIMIT %s OFFSET %s
+        """,
+        (user_id, limit, offset)
+    )
+    return cur.fetchall()
+
+
+def insert_booking(cur, user_id, class_name, class_date, class_time, class_start_utc, booking_date, course_appointment_id):
+    cur.execute(
+        """
+        INSERT INTO bookings 
+        (user_id, class_name, class_date, class_time, class_start_utc, booking_date, status, course_appointment_id)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        RETURNING id
+        """,
+        (user_id, class_name, class_date, class_time, class_start_utc, booking_date, 'pending', course_appointment_id)
+    )
+    booking_id = cur.fetchone()[0]
+    upsert_booking_jobs(cur, [(booking_id, booking_date)])
+    return booking_id
+
+
+def select_user_booking(cur, booking_id, user_id):
+    cur.execute(
+        "SELECT class_name, class_date, class_time, status, easyfit_booking_id FROM bookings WHERE id = %s AND user_id = %s",
+        (booking_id, user_id)
+    )
+    return cur.fetchone()
+
+
+def delete_booking(cur, booking_id):
+    cur.execute("DELETE FROM bookings WHERE id = %s", (booking_id,))
+
+
+BOOKING_COLUMNS = "id, user_id, class_name, class_date, class_time, booking_date, course_appointment_id"
+
+
+def recover_expired_leases(cur):
+    """Rimette pending le prenotazioni in_progress il cui lease è scaduto (istanza caduta)"""
+    cur.execute(
+        """
+        UPDATE bookings
+        SET status = 'pending', lease_owner = NULL, lease_expires_at = NULL
+        FROM (
+            SELECT id, lease_owner FROM bookings
+            WHERE status = 'in_progress' AND lease_expires_at < NOW()
+            FOR UPDATE SKIP LOCKED
+        ) AS expired
+        WHERE bookings.id = expired.id
+        RETURNING bookings.id, expired.lease_owner
+        """
+    )
+    return cur.fetchall()
+
+
+def claim_due_bookings(cur, now_utc, owner, lease_seconds, exclude_ids, limit):
+    """
+    Prende in carico in modo atomico fino a `limit` prenotazioni pending
+    scadute: le righe bloccate da un'altra istanza vengono saltate
+    (SKIP LOCKED) e quelle prese passano a in_progress con lease.
+    """
+    cur.execute(
+        f"""
+        UPDATE bookings
+        SET status = 'in_progress',
+            lease_owner = %s,
+            lease_expires_at = NOW() + %s * INTERVAL '1 second'
+        WHERE id IN (
+            SELECT id FROM bookings
+            WHERE status = 'pending'
+            AND booking_date <= %s
+            AND id <> ALL(%s)
+            ORDER BY booking_date ASC
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING {BOOKING_COLUMNS}
+        """,
+        (owner, lease_seconds, now_utc, list(exclude_ids), limit)
+    )
+    return sorted(cur.fetchall(), key=lambda booking: booking[5])
+
+
+def claim_overdue_bookings(cur, now_utc, owner, lease_seconds, exclude_ids, limit):
+    """
+    Come claim_due_bookings, in ordine di urgenza per il recupero all'avvio:
+    prima le lezioni che iniziano prima, a parità quelle scadute da più tempo.
+    """
+    cur.execute(
+        f"""
+        UPDATE bookings
+        SET status = 'in_progress',
+            lease_owner = %s,
+            lease_expires_at = NOW() + %s * INTERVAL '1 second'
+        WHERE id IN (
+            SELECT id FROM bookings
+            WHERE status = 'pending'
+            AND booking_date <= %s
+            AND id <> ALL(%s)
+            ORDER BY class_start_utc ASC, booking_date ASC
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING {BOOKING_COLUMNS}
+        """,
+        (owner, lease_seconds, now_utc, list(exclude_ids), limit)
+    )
+    return sorted(cur.fetchall(), key=lambda booking: (str(booking[3]), booking[4], booking[5]))
+
+
+def claim_booking(cur, booking_id, owner, lease_seconds):
+    """Prende in carico una singola prenotazione pending; None se non lo è più"""
+    cur.execute(
+        f"""
+        UPDATE bookings
+        SET status = 'in_progress',
+            lease_owner = %s,
+            lease_expires_at = NOW() + %s * INTERVAL '1 second'
+        WHERE id = (
+            SELECT id FROM bookings
+            WHERE id = %s AND status = 'pending'
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING {BOOKING_COLUMNS}
+        """,
+        (owner, lease_seconds, booking_id)
+    )
+    return cur.fetchone()
+
+
+def renew_booking_leases(cur, booking_ids, owner, lease_seconds):
+    """Allunga il lease delle prenotazioni ancora in_progress di questa istanza; ritorna gli ID rinnovati"""
+    cur.execute(
+        """
+        UPDATE bookings
+        SET lease_expires_at = NOW() + %s * INTERVAL '1 second'
+        WHERE id = ANY(%s) AND status = 'in_progress' AND lease_owner = %s
+        RETURNING id
+        """,
+        (lease_seconds, list(booking_ids), owner)
+    )
+    return {row[0] for row in cur.fetchall()}
+
+
+def release_booking_claims(cur, booking_ids, owner):
+    """Rimette pending le prenotazioni prese in carico ma non eseguite"""
+    cur.execute(
+        """
+        UPDATE bookings
+        SET status = 'pending', lease_owner = NULL, lease_expires_at = NULL
+        WHERE id = ANY(%s) AND status = 'in_progress' AND lease_owner = %s
+        """,
+        (list(booking_ids), owner)
+    )
+
+
+def select_pending_booking(cur, booking_id):
+    cur.execute(
+        f"SELECT {BOOKING_COLUMNS} FROM bookings WHERE id = %s AND status = 'pending'",
+        (booking_id,)
+    )
+    return cur.fetchone()
+
+
+def select_next_due(cur):
+    """Prossima scadenza della coda: primo booking_date pending o primo lease in scadenza"""
+    cur.execute(
+        """
+        SELECT LEAST(
+            (SELECT MIN(booking_date) FROM bookings WHERE status = 'pending'),
+            (SELECT MIN(lease_expires_at) FROM bookings WHERE status = 'in_progress')
+        )
+        """
+    )
+    return cur.fetchone()[0]
+
+
+def upsert_booking_jobs(cur, bookings):
+    """Scrive nel job store i timer delle prenotazioni (booking_id, booking_date), con il loro orario di sparo"""
+    psycopg2.extras.execute_values(
+        cur,
+        """
+        INSERT INTO scheduler_jobs (job_id, kind, booking_id, run_at) VALUES %s
+        ON CONFLICT (job_id) DO UPDATE
+        SET run_at = EXCLUDED.run_at, updated_at = NOW()
+        WHERE scheduler_jobs.run_at IS DISTINCT FROM EXCLUDED.run_at
+        """,
+        [
+            (f'booking_{booking_id}', 'booking', booking_id, booking_fire_time(booking_date))
+            for booking_id, booking_date in bookings
+        ]
+    )
+
+
+def backfill_booking_jobs(cur):
+    """Crea i job mancanti per le prenotazioni pending (dopo la migrazione 9); ritorna quanti"""
+    cur.execute(
+        """
+        SELECT id, booking_date FROM bookings
+        WHERE status = 'pending'
+        AND NOT EXISTS (SELECT 1 FROM scheduler_jobs WHERE scheduler_jobs.booking_id = bookings.id)
+        """
+    )
+    bookings = cur.fetchall()
+    if bookings:
+        upsert_booking_jobs(cur, bookings)
+    return len(bookings)
+
+
+def select_future_booking_jobs(cur):
+    """Timer ancora da eseguire dal job store, solo per prenotazioni pending (booking_id, booking_date)"""
+    cur.execute(
+        """
+        SELECT scheduler_jobs.booking_id, bookings.booking_date
+        FROM scheduler_jobs
+        JOIN bookings ON bookings.id = scheduler_jobs.booking_id AND bookings.status = 'pending'
+        WHERE scheduler_jobs.run_at > NOW() AND scheduler_jobs.kind = 'booking'
+        ORDER BY scheduler_jobs.run_at
+        """
+    )
+    return cur.fetchall()
+
+
+def update_course_appointment_id(cur, booking_id, course_appointment_id):
+    cur.execute(
+        "UPDATE bookings SET course_appointment_id = %s WHERE id = %s AND status = 'pending'",
+        (course_appointment_id, booking_id)
+    )
+
+
+def outcome_row(outcome, owner):
+    error_code = None if outcome.result in ('completed', 'waitlisted') else outcome.result
+    return (
+        outcome.booking_id, outcome.status, outcome.easyfit_booking_id, error_code,
+        outcome.offset_ms, len(outcome.attempts), owner
+    )
+
+
+def update_booking_outcomes(cur, outcomes, owner):
+    """
+    Scrive gli esiti con un solo UPDATE ... FROM (VALUES ...), solo per le
+    righe il cui lease è ancora di `owner`. Ritorna gli ID aggiornati.
+    """
+    if not outcomes:
+        return set()
+    rows = psycopg2.extras.execute_values(
+        cur,
+        """
+        UPDATE bookings
+        SET status = v.status,
+            easyfit_booking_id = v.easyfit_booking_id,
+            error_code = v.error_code,
+            fire_offset_ms = v.fire_offset_ms,
+            attempts = v.attempts,
+            processed_at = NOW(),
+            lease_owner = NULL,
+            lease_expires_at = NULL
+        FROM (VALUES %s) AS v(id, status, easyfit_booking_id, error_code, fire_offset_ms, attempts, owner)
+        WHERE bookings.id = v.id
+        AND bookings.status = 'in_progress'
+        AND bookings.lease_owner = v.owner
+        RETURNING bookings.id
+        """,
+        [outcome_row(outcome, owner) for outcome in outcomes],
+        template="(%s::integer, %s::varchar, %s::bigint, %s::varchar, %s::real, %s::integer, %s::varchar)",
+        fetch=True
+    )
+    saved = {row[0] for row in rows}
+    if saved:
+        # Esito salvato: il timer non serve più
+        cur.execute("DELETE FROM scheduler_jobs WHERE booking_id = ANY(%s)", (list(saved),))
+    return saved
+
+
+def update_booking_outcome(cur, outcome, owner):
+    """Scrive l'esito solo se il lease è ancora di `owner`; False altrimenti"""
+    return outcome.booking_id in update_booking_outcomes(cur, [outcome], owner)
+
+
+HISTORY_COLUMNS = (
+    "id, user_id, class_name, class_date, class_time, class_start_utc, booking_date, status, "
+    "created_at, easyfit_booking_id, course_appointment_id, processed_at, error_code, "
+    "fire_offset_ms, attempts"
+)
+
+
+def ensure_history_partition(cur, month_start):
+    """Crea, se manca, la partizione mensile di bookings_history che contiene month_start (UTC)"""
+    next_month = (month_start.replace(day=1) + timedelta(days=32)).replace(day=1)
+    cur.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS bookings_history_{month_start.strftime('%Y_%m')}
+        PARTITION OF bookings_history
+        FOR VALUES FROM (%s) TO (%s)
+        """,
+        (month_start.strftime('%Y-%m-01 00:00+00'), next_month.strftime('%Y-%m-01 00:00+00'))
+    )
+
+
+def archive_past_bookings(cur, older_than_hours, limit):
+    """
+    Sposta in bookings_history fino a `limit` prenotazioni di lezioni iniziate
+    da più di older_than_hours ore, nella stessa transazione. Ritorna le righe spostate.
+    """
+    cur.execute(
+        """
+        SELECT id, date_trunc('month', class_start_utc AT TIME ZONE 'UTC')
+        FROM bookings
+        WHERE class_start_utc < NOW() - %s * INTERVAL '1 hour'
+        AND status <> 'in_progress'
+        ORDER BY class_start_utc
+        LIMIT %s
+        FOR UPDATE SKIP LOCKED
+        """,
+        (older_than_hours, limit)
+    )
+    rows = cur.fetchall()
+    if not rows:
+        return 0
+    for month_start in sorted({month for _, month in rows}):
+        ensure_history_partition(cur, month_start)
+    cur.execute(
+        f"""
+        WITH moved AS (
+            DELETE FROM bookings WHERE id = ANY(%s)
+            RETURNING {HISTORY_COLUMNS}
+        )
+        INSERT INTO bookings_history ({HISTORY_COLUMNS})
+        SELECT {HISTORY_COLUMNS} FROM moved
+        """,
+        ([booking_id for booking_id, _ in rows],)
+    )
+    return cur.rowcount
+
+
+def select_user_history(cur, user_id, limit):
+    """Ultime lezioni passate dell'utente: archivio più quelle non ancora archiviate"""
+    cur.execute(
+        """
+        SELECT id, class_name, class_start_utc, status, easyfit_booking_id, error_code
+        FROM (
+            SELECT id, class_name, class_start_utc, status, easyfit_booking_id, error_code
+            FROM bookings
+            WHERE user_id = %s AND class_start_utc <= NOW() AND status <> 'in_progress'
+            UNION ALL
+            SELECT id, class_name, class_start_utc, status, easyfit_booking_id, error_code
+            FROM bookings_history
+            WHERE user_id = %s
+        ) AS past
+        ORDER BY class_start_utc DESC
+        LIMIT %s
+        """,
+        (user_id, user_id, limit)
+    )
+    return cur.fetchall()
+
+
+# =============================================================================
+# ASYNC DATABASE
+# =============================================================================
+
+class AsyncDatabase:
+    """
+    Unico accesso al DB del bot (handler Telegram, prenotazioni e job dello
+    scheduler). Le query psycopg2 girano su un executor dedicato, con qualche
+    thread in più delle connessioni del pool (così a pool esaurito si attende
+    nel pool, con DB_POOL_WAIT_TIMEOUT), e ogni chiamata ha un timeout, così
+    un Postgres lento non blocca l'event loop del bot.
+    """
+
+    def __init__(self, min_connections=DB_POOL_MIN, max_connections=DB_POOL_MAX, timeout=ASYNC_DB_TIMEOUT):
+        self.min_connections = min_connections
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._pool = None
+        self._pool_lock = Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_connections + DB_EXECUTOR_EXTRA_WORKERS, thread_name_prefix='db'
+        )
+
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ManagedConnectionPool(
+                    minconn=self.min_connections,
+                    maxconn=self.max_connections,
+                    dsn=DATABASE_URL,
+                    sslmode='require',
+                    connect_timeout=int(self.timeout)
+                )
+                logger.info(f"💾 Connection pool inizializzato ({self.min_connections}-{self.max_connections} connessioni)")
+            return self._pool
+
+    async def run(self, operation, *args, commit=False, timeout=None):
+        """Esegue operation(cur, *args) sull'executor del DB, con timeout"""
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(
+            loop.run_in_executor(self._executor, lambda: self._get_pool().run(lambda cur: operation(cur, *args), commit=commit)),
+            timeout or self.timeout
+        )
+
+    async def fetch_user_bookings(self, user_id, limit, offset=0):
+        return await self.run(select_user_bookings, user_id, limit, offset)
+
+    async def insert_booking(self, user_id, class_name, class_date, class_time, class_start_utc, booking_date, course_appointment_id):
+        return await self.run(
+            insert_booking, user_id, class_name, class_date, class_time, class_start_utc, booking_date, course_appointment_id,
+            commit=True
+        )
+
+    async def fetch_user_history(self, user_id, limit=STORICO_LIMIT):
+        return await self.run(select_user_history, user_id, limit)
+
+    async def fetch_user_booking(self, booking_id, user_id):
+        return await self.run(select_user_booking, booking_id, user_id)
+
+    async def delete_booking(self, booking_id):
+        await self.run(delete_booking, booking_id, commit=True)
+
+    async def recover_expired_leases(self):
+        return await self.run(recover_expired_leases, commit=True)
+
+    async def claim_due_bookings(self, now_utc, exclude_ids=(), limit=BOOKING_CONCURRENCY):
+        return await self.run(
+            claim_due_bookings, now_utc, INSTANCE_ID, BOOKING_LEASE_SECONDS, exclude_ids, limit,
+            commit=True
+        )
+
+    async def claim_overdue_bookings(self, now_utc, exclude_ids=(), limit=BOOKING_CONCURRENCY):
+        return await self.run(
+            claim_overdue_bookings, now_utc, INSTANCE_ID, BOOKING_LEASE_SECONDS, exclude_ids, limit,
+            commit=True
+        )
+
+    async def claim_booking(self, booking_id):
+        return await self.run(claim_booking, booking_id, INSTANCE_ID, BOOKING_LEASE_SECONDS, commit=True)
+
+    async def renew_booking_leases(self, booking_ids):
+        return await self.run(renew_booking_leases, booking_ids, INSTANCE_ID, BOOKING_LEASE_SECONDS, commit=True)
+
+    async def release_booking_claims(self, booking_ids):
+        await self.run(release_booking_claims, booking_ids, INSTANCE_ID, commit=True)
+
+    async def fetch_pending_booking(self, booking_id):
+        return await self.run(select_pending_booking, booking_id)
+
+    async def fetch_next_due(self):
+        return await self.run(select_next_due)
+
+    async def fetch_future_booking_jobs(self):
+        return await self.run(select_future_booking_jobs)
+
+    async def update_course_appointment_id(self, booking_id, course_appointment_id):
+        await self.run(update_course_appointment_id, booking_id, course_appointment_id, commit=True)
+
+    async def save_booking_outcomes(self, outcomes):
+        return await self.run(update_booking_outcomes, outcomes, INSTANCE_ID, commit=True)
+
+    async def archive_past_bookings(self, older_than_hours=BOOKING_ARCHIVE_AFTER_HOURS, limit=BOOKING_ARCHIVE_BATCH_SIZE):
+        return await self.run(archive_past_bookings, older_than_hours, limit, commit=True)
+
+    def metrics(self):
+        return self._pool.metrics() if self._pool else None
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+        if self._pool is not None:
+            self._pool.closeall()
+            self._pool = None
+
+
+# DB asincrono globale (handler, prenotazioni e job)
+async_db = AsyncDatabase()
 
 
 # =============================================================================
@@ -121,210 +1148,584 @@ def parse_course_datetime(date_string):
         return None
 
 
-def easyfit_login():
-    try:
-        logger.info("🔐 Login EasyFit...")
-        session = requests.Session()
-        url = f"{EASYFIT_BASE_URL}/login"
-        import base64
-        credentials = f"{EASYFIT_EMAIL}:{EASYFIT_PASSWORD}"
-        basic_auth = base64.b64encode(credentials.encode()).decode()
-        headers = {
-            "Content-Type": "application/json",
-            "Accept": "*/*",
-            "Accept-Language": "it-IT,it;q=0.9",
-            "Authorization": f"Basic {basic_auth}",
-            "Origin": "https://app-easyfitpalestre.it",
-            "Referer": "https://app-easyfitpalestre.it/studio/ZWFzeWZpdDoxMjE2OTE1Mzgw/course",
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-            "x-tenant": "easyfit",
-            "x-ms-web-context": "/studio/ZWFzeWZpdDoxMjE2OTE1Mzgw",
-            "x-nox-client-type": "WEB",
-            "x-nox-web-context": "v=1",
-            "x-public-facility-group": "BRANDEDAPP-263FBF081EAB42E6A62602B2DDDE4506"
-        }
-        payload = {
-            "username": EASYFIT_EMAIL,
-            "password": EASYFIT_PASSWORD
-        }
-        response = session.post(url, json=payload, headers=headers, timeout=10)
-        if response.status_code == 200:
-            data = response.json()
-            session_id = data.get('sessionId')
-            logger.info(f"✅ Login OK! SessionID: {session_id[:20] if session_id else 'N/A'}...")
-            session.session_id = session_id
-            return session
-        else:
-            logger.error(f"❌ Login fallito: {response.status_code}")
-            logger.error(f"   Response: {response.text[:200]}")
-            return None
-    except Exception as e:
-        logger.error(f"❌ Errore login: {e}")
+EASYFIT_STUDIO_PATH = "/studio/ZWFzeWZpdDoxMjE2OTE1Mzgw"
+EASYFIT_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36"
+
+# Header comuni a tutte le chiamate della web app EasyFit
+EASYFIT_COMMON_HEADERS = {
+    "Accept-Language": "it-IT,it;q=0.9",
+    "Origin": "https://app-easyfitpalestre.it",
+    "User-Agent": EASYFIT_USER_AGENT,
+    "x-tenant": "easyfit",
+    "x-ms-web-context": EASYFIT_STUDIO_PATH,
+    "x-nox-client-type": "WEB",
+    "x-nox-web-context": "v=1",
+    "x-public-facility-group": "BRANDEDAPP-263FBF081EAB42E6A62602B2DDDE4506"
+}
+
+CALENDAR_HEADERS = {
+    **EASYFIT_COMMON_HEADERS,
+    "Accept": "application/json, text/plain, */*",
+    "Referer": f"https://app-easyfitpalestre.it{EASYFIT_STUDIO_PATH}/course"
+}
+
+BOOKING_HEADERS = {
+    **CALENDAR_HEADERS,
+    "Content-Type": "application/json"
+}
+
+CANCEL_HEADERS = {
+    **EASYFIT_COMMON_HEADERS,
+    "Accept": "*/*",
+    "Content-Type": "application/json",
+    "Referer": f"https://app-easyfitpalestre.it{EASYFIT_STUDIO_PATH}/calendar"
+}
+
+
+def easyfit_login_request():
+    """Header e payload per il login Basic-auth su EasyFit"""
+    import base64
+    credentials = f"{EASYFIT_EMAIL}:{EASYFIT_PASSWORD}"
+    basic_auth = base64.b64encode(credentials.encode()).decode()
+    headers = {
+        **EASYFIT_COMMON_HEADERS,
+        "Content-Type": "application/json",
+        "Accept": "*/*",
+        "Authorization": f"Basic {basic_auth}",
+        "Referer": f"https://app-easyfitpalestre.it{EASYFIT_STUDIO_PATH}/course"
+    }
+    payload = {
+        "username": EASYFIT_EMAIL,
+        "password": EASYFIT_PASSWORD
+    }
+    return headers, payload
+
+
+class EasyFitLoginError(Exception):
+    """Login EasyFit non riuscito"""
+
+
+def slot_date_key(slot):
+    """Data 'YYYY-MM-DD' di uno slot così come restituita da EasyFit"""
+    start_datetime_str = slot.get('startDateTime', '')
+    if not start_datetime_str:
         return None
+    return start_datetime_str.split('[')[0].split('T')[0]
 
 
-def get_calendar_courses(session, start_date, end_date):
-    try:
-        logger.info(f"📅 Range: {start_date} → {end_date}")
-        url = f"{EASYFIT_BASE_URL}/nox/public/v2/bookableitems/courses/with-canceled"
-        params = {
-            "startDate": start_date,
-            "endDate": end_date,
-            "employeeIds": "",
-            "organizationUnitIds": ORGANIZATION_UNIT_ID
-        }
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-            "Accept": "application/json, text/plain, */*",
-            "Accept-Language": "it-IT,it;q=0.9",
-            "Origin": "https://app-easyfitpalestre.it",
-            "Referer": f"https://app-easyfitpalestre.it/studio/ZWFzeWZpdDoxMjE2OTE1Mzgw/course",
-            "x-tenant": "easyfit",
-            "x-ms-web-context": "/studio/ZWFzeWZpdDoxMjE2OTE1Mzgw",
-            "x-nox-client-type": "WEB",
-            "x-nox-web-context": "v=1",
-            "x-public-facility-group": "BRANDEDAPP-263FBF081EAB42E6A62602B2DDDE4506"
-        }
-        logger.info(f"🔍 Richiesta calendario...")
-        response = session.get(url, params=params, headers=headers, timeout=15)
-        if response.status_code == 200:
-            courses = response.json()
-            logger.info(f"✅ Recuperate {len(courses)} lezioni")
-            if courses:
-                logger.info("🔍 DEBUG - Prime 3 lezioni RAW:")
-                for i, course in enumerate(courses[:3]):
-                    logger.info(f"   #{i+1}: {course}")
+class CalendarCache:
+    """
+    Cache in memoria del calendario EasyFit, con granularità giornaliera:
+    una richiesta di 7 giorni riempie anche le voci dei singoli giorni.
+    Ogni giorno scade dopo `ttl` secondi; oltre `max_days` giorni in cache
+    viene scartato quello usato meno di recente (LRU).
+    """
+
+    def __init__(self, ttl=CALENDAR_CACHE_TTL, max_days=CALENDAR_CACHE_MAX_DAYS):
+        self.ttl = ttl
+        self.max_days = max_days
+        self.hits = 0
+        self.misses = 0
+        self._days = OrderedDict()  # 'YYYY-MM-DD' -> (fetched_at, [lezioni])
+        self._lock = Lock()
+
+    @staticmethod
+    def days_in_range(start_date, end_date):
+        """Giorni del range [start_date, end_date), almeno start_date"""
+        start = datetime.strptime(start_date, '%Y-%m-%d')
+        end = datetime.strptime(end_date, '%Y-%m-%d')
+        days = [start.strftime('%Y-%m-%d')]
+        current = start + timedelta(days=1)
+        while current < end:
+            days.append(current.strftime('%Y-%m-%d'))
+            current += timedelta(days=1)
+        return days
+
+    def get(self, start_date, end_date):
+        """Lezioni del range se tutti i giorni sono in cache e validi, altrimenti None"""
+        now = time.monotonic()
+        with self._lock:
+            courses = []
+            seen = set()
+            for day in self.days_in_range(start_date, end_date):
+                entry = self._days.get(day)
+                if entry is None or now - entry[0] > self.ttl:
+                    self.misses += 1
+                    return None
+                self._days.move_to_end(day)
+                for course in entry[1]:
+                    key = course.get('id', id(course))
+                    if key not in seen:
+                        seen.add(key)
+                        courses.append(course)
+            self.hits += 1
             return courses
-        else:
-            logger.error(f"❌ Errore calendario: {response.status_code}")
-            logger.error(f"   Response: {response.text[:200]}")
-            return []
-    except Exception as e:
-        logger.error(f"❌ Errore get_calendar_courses: {e}")
-        return []
 
+    def put(self, start_date, end_date, courses):
+        days = self.days_in_range(start_date, end_date)
+        by_day = {day: [] for day in days}
+        for course in courses:
+            for day in {slot_date_key(slot) for slot in course.get('slots', [])}:
+                if day in by_day:
+                    by_day[day].append(course)
+        now = time.monotonic()
+        with self._lock:
+            for day in days:
+                self._days[day] = (now, by_day[day])
+                self._days.move_to_end(day)
+            while len(self._days) > self.max_days:
+                self._days.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._days.clear()
+
+
+# Cache calendario condivisa tra handler e scheduler
+calendar_cache = CalendarCache()
+
+
+CourseSlot = namedtuple('CourseSlot', [
+    'course_id', 'name', 'date', 'time', 'start_raw',
+    'booked', 'max_participants',
+    'waiting_list_active', 'waiting_list_participants', 'max_waiting_list_participants'
+])
+
+
+# Singolo tentativo di bookcourse: HTTP status, latenza e classificazione dell'errore
+BookingAttempt = namedtuple('BookingAttempt', ['status_code', 'latency_ms', 'kind'])
+
+
+def normalize_class_name(name):
+    return ' '.join((name or '').lower().split())
+
+
+class CalendarIndex:
+    """
+    Indice di un payload calendario, costruito una volta per fetch.
+    Lookup O(1) per (nome normalizzato, data, ora inizio HH:MM) e per
+    startDateTime grezzo, con ID lezione, posti e lista d'attesa.
+    Data e ora sono quelle restituite da EasyFit, come salvate nel DB.
+    """
+
+    def __init__(self, courses):
+        self.by_key = {}        # (nome, 'YYYY-MM-DD', 'HH:MM') -> CourseSlot
+        self.by_start = {}      # startDateTime grezzo -> {nome: CourseSlot}
+        self._by_slot_time = {} # ('YYYY-MM-DD', 'HH:MM') -> [CourseSlot]
+        for course in courses or []:
+            name = normalize_class_name(course.get('name', ''))
+            for slot in course.get('slots', []):
+                start_raw = slot.get('startDateTime', '')
+                if not start_raw:
+                    continue
+                slot_datetime = parse_course_datetime(start_raw.split('[')[0])
+                if not slot_datetime:
+                    continue
+                entry = CourseSlot(
+                    course_id=course.get('id'),
+                    name=course.get('name', ''),
+                    date=slot_datetime.strftime('%Y-%m-%d'),
+                    time=slot_datetime.strftime('%H:%M'),
+                    start_raw=start_raw,
+                    booked=course.get('bookedParticipants', 0),
+                    max_participants=course.get('maxParticipants', 0),
+                    waiting_list_active=course.get('waitingListActive', False),
+                    waiting_list_participants=course.get('waitingListParticipants', 0),
+                    max_waiting_list_participants=course.get('maxWaitingListParticipants', 0)
+                )
+                self.by_key.setdefault((name, entry.date, entry.time), entry)
+                self.by_start.setdefault(start_raw, {}).setdefault(name, entry)
+                self._by_slot_time.setdefault((entry.date, entry.time), []).append(entry)
+
+    def __len__(self):
+        return len(self.by_key)
+
+    def find(self, class_name, class_date, class_time):
+        """Slot per nome/data/ora; se il nome non coincide esattamente, match parziale sullo stesso orario"""
+        name = normalize_class_name(class_name)
+        class_date, class_time = str(class_date), str(class_time)[:5]
+        entry = self.by_key.get((name, class_date, class_time))
+        if entry:
+            return entry
+        for candidate in self._by_slot_time.get((class_date, class_time), []):
+            if name in normalize_class_name(candidate.name):
+                return candidate
+        return None
+
+    def at_start(self, start_raw, class_name):
+        return self.by_start.get(start_raw, {}).get(normalize_class_name(class_name))
+
+
+def calendar_params(start_date, end_date):
+    return {
+        "startDate": start_date,
+        "endDate": end_date,
+        "employeeIds": "",
+        "organizationUnitIds": ORGANIZATION_UNIT_ID
+    }
+
+
+def parse_calendar_response(response):
+    """Estrae le lezioni dalla risposta del calendario"""
+    if response.status_code == 200:
+        courses = response.json()
+        logger.info(f"✅ Recuperate {len(courses)} lezioni")
+        if courses:
+            logger.info("🔍 DEBUG - Prime 3 lezioni RAW:")
+            for i, course in enumerate(courses[:3]):
+                logger.info(f"   #{i+1}: {course}")
+        return courses
+    logger.error(f"❌ Errore calendario: {response.status_code}")
+    logger.error(f"   Response: {response.text[:200]}")
+    return []
+
+
+def booking_payload(course_appointment_id, expected_status="BOOKED"):
+    return {
+        "courseAppointmentId": course_appointment_id,
+        "expectedCustomerStatus": expected_status
+    }
 
-def book_course_easyfit(session, course_appointment_id, try_waitlist=True):
+
+def booking_error_code(response):
+    """(errorCode, errorCode + messaggio) di una risposta di errore EasyFit, in minuscolo"""
     try:
-        logger.info(f"📝 Prenotazione ID: {course_appointment_id}")
-        url = f"{EASYFIT_BASE_URL}/nox/v1/calendar/bookcourse"
-        headers = {
-            "Content-Type": "application/json",
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-            "Accept": "application/json, text/plain, */*",
-            "Accept-Language": "it-IT,it;q=0.9",
-            "Origin": "https://app-easyfitpalestre.it",
-            "Referer": "https://app-easyfitpalestre.it/studio/ZWFzeWZpdDoxMjE2OTE1Mzgw/course",
-            "x-tenant": "easyfit",
-            "x-ms-web-context": "/studio/ZWFzeWZpdDoxMjE2OTE1Mzgw",
-            "x-nox-client-type": "WEB",
-            "x-nox-web-context": "v=1",
-            "x-public-facility-group": "BRANDEDAPP-263FBF081EAB42E6A62602B2DDDE4506"
-        }
-        payload = {
-            "courseAppointmentId": course_appointment_id,
-            "expectedCustomerStatus": "BOOKED"
-        }
-        response = session.post(url, json=payload, headers=headers, timeout=10)
-        if response.status_code == 200:
-            logger.info(f"✅ PRENOTATO!")
-            return True, "completed", response.json()
-        logger.info(f"⚠️ Prenotazione normale fallita: {response.status_code}")
-        logger.info(f"   Response: {response.text[:300]}")
-        if try_waitlist:
-            logger.info(f"⏳ Provo lista d'attesa...")
-            waitlist_payload = {
-                "courseAppointmentId": course_appointment_id,
-                "expectedCustomerStatus": "WAITING_LIST"
-            }
-            waitlist_response = session.post(url, json=waitlist_payload, headers=headers, timeout=10)
-            if waitlist_response.status_code == 200:
-                logger.info(f"✅ IN LISTA D'ATTESA!")
-                return True, "waitlisted", waitlist_response.json()
-            else:
-                logger.warning(f"❌ Lista d'attesa fallita: {waitlist_response.status_code}")
-                logger.warning(f"   Response: {waitlist_response.text[:300]}")
-                try:
-                    error_data = waitlist_response.json()
-                    error_code = error_data[0].get('errorCode', '') if isinstance(error_data, list) else error_data.get('errorCode', '')
-                    if 'full' in error_code.lower() or 'piena' in error_code.lower():
-                        return False, "full", None
-                    else:
-                        return False, "waitlist_unavailable", None
-                except:
-                    return False, "waitlist_unavailable", None
-        return False, "full", None
-    except Exception as e:
-        logger.error(f"❌ Errore book_course_easyfit: {e}")
-        return False, "error", None
+        error_data = response.json()
+        if isinstance(error_data, list):
+            error_data = error_data[0] if error_data else {}
+        error_code = str(error_data.get('errorCode', '')).strip().lower()
+        return error_code, f"{error_code} {str(error_data.get('message', '')).lower()}".strip()
+    except Exception:
+        return '', response.text[:300].lower()
 
 
-def find_course_id(session, class_name, class_date, class_time):
+def classify_booking_error(response):
+    """
+    Classifica il rifiuto di un bookcourse:
+    'full', 'not_open' (finestra non ancora aperta), 'already_booked' (solo per
+    un errorCode in BOOKING_ALREADY_ERROR_CODES), 'auth' (sessione non valida)
+    oppure 'other'.
+    """
+    if response.status_code in (401, 403):
+        return 'auth'
+    error_code, error_text = booking_error_code(response)
+    if any(marker in error_text for marker in BOOKING_FULL_MARKERS):
+        return 'full'
+    if error_code in BOOKING_ALREADY_ERROR_CODES:
+        return 'already_booked'
+    if any(marker in error_text for marker in BOOKING_NOT_OPEN_MARKERS):
+        return 'not_open'
+    return 'other'
+
+
+def waitlist_failure_status(waitlist_response):
+    """Interpreta il rifiuto della lista d'attesa: 'full' o 'waitlist_unavailable'"""
+    logger.warning(f"❌ Lista d'attesa fallita: {waitlist_response.status_code}")
+    logger.warning(f"   Response: {waitlist_response.text[:300]}")
+    if classify_booking_error(waitlist_response) == 'full':
+        return "full"
+    return "waitlist_unavailable"
+
+
+def booking_rejection_result(response, deadline):
+    """
+    Decide cosa fare dopo un rifiuto del bookcourse. Ritorna (classificazione, azione):
+    'retry' (finestra non aperta e burst entro `deadline`), 'waitlist' oppure
+    lo status finale della prenotazione.
+    """
+    kind = classify_booking_error(response)
+    if kind == 'not_open':
+        if time.monotonic() < deadline:
+            return kind, 'retry'
+        logger.warning("⏳ Prenotazione ancora non aperta, burst esaurito")
+        return kind, 'not_open'
+    if kind == 'already_booked':
+        logger.info("ℹ️ Lezione già prenotata su EasyFit")
+        return kind, 'completed'
+    if kind == 'auth':
+        return kind, 'error'
+    return kind, 'waitlist'
+
+
+def log_booking_attempts(attempts):
+    if len(attempts) > 1:
+        latencies = ', '.join(f"{a.latency_ms:.0f}" for a in attempts)
+        logger.info(f"🔁 {len(attempts)} tentativi di prenotazione (ms: {latencies})")
+
+
+def match_course_id(index, class_name, class_date, class_time):
+    """Cerca l'ID della lezione nell'indice di un calendario già scaricato"""
     try:
         logger.info(f"🔎 Cerco: {class_name} {class_date} {class_time}")
-        target_date = datetime.strptime(class_date, '%Y-%m-%d')
-        start_date = target_date.strftime('%Y-%m-%d')
-        end_date = (target_date + timedelta(days=1)).strftime('%Y-%m-%d')
-        courses = get_calendar_courses(session, start_date, end_date)
-        if not courses:
+        if not index:
             logger.warning(f"❌ Nessuna lezione nel calendario per {class_date}")
             return None
-        for course in courses:
-            course_name = course.get('name', '')
-            for slot in course.get('slots', []):
-                start_datetime_str = slot.get('startDateTime', '')
-                if start_datetime_str:
-                    start_datetime_str = start_datetime_str.split('[')[0]
-                    slot_datetime = parse_course_datetime(start_datetime_str)
-                    if slot_datetime:
-                        course_time_str = slot_datetime.strftime('%H:%M')
-                        if class_name.lower() in course_name.lower() and course_time_str == class_time:
-                            course_id = course.get('id')
-                            logger.info(f"✅ Trovato ID: {course_id}")
-                            logger.info(f"   Nome: {course_name}")
-                            logger.info(f"   Orario INIZIO: {course_time_str}")
-                            booked = course.get('bookedParticipants', 0)
-                            max_slots = course.get('maxParticipants', 0)
-                            if max_slots:
-                                available = max_slots - booked
-                                logger.info(f"   Posti: {available}/{max_slots}")
-                            return course_id
-        logger.warning(f"❌ Lezione non trovata: {class_name} {class_date} {class_time}")
-        return None
+        entry = index.find(class_name, class_date, class_time)
+        if not entry:
+            logger.warning(f"❌ Lezione non trovata: {class_name} {class_date} {class_time}")
+            return None
+        logger.info(f"✅ Trovato ID: {entry.course_id}")
+        logger.info(f"   Nome: {entry.name}")
+        logger.info(f"   Orario INIZIO: {entry.time}")
+        if entry.max_participants:
+            available = entry.max_participants - entry.booked
+            logger.info(f"   Posti: {available}/{entry.max_participants}")
+        return entry.course_id
     except Exception as e:
-        logger.error(f"❌ Errore find_course_id: {e}")
+        logger.error(f"❌ Errore match_course_id: {e}")
         return None
 
 
-def cancel_booking_easyfit(session, easyfit_booking_id):
-    try:
-        logger.info(f"🗑️ Cancellazione prenotazione EasyFit ID: {easyfit_booking_id}")
-        url = f"{EASYFIT_BASE_URL}/v1/aggregated/calendaritems/easyfit:{easyfit_booking_id}"
-        headers = {
-            "Accept": "*/*",
-            "Accept-Language": "it-IT,it;q=0.9",
-            "Content-Type": "application/json",
-            "Origin": "https://app-easyfitpalestre.it",
-            "Referer": "https://app-easyfitpalestre.it/studio/ZWFzeWZpdDoxMjE2OTE1Mzgw/calendar",
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36",
-            "x-tenant": "easyfit",
-            "x-nox-client-type": "WEB",
-            "x-nox-web-context": "v=1",
-            "x-public-facility-group": "BRANDEDAPP-263FBF081EAB42E6A62602B2DDDE4506",
-            "x-ms-web-context": "/studio/ZWFzeWZpdDoxMjE2OTE1Mzgw"
-        }
-        response = session.delete(url, headers=headers, timeout=10)
-        if response.status_code == 200:
-            logger.info("✅ Prenotazione cancellata su EasyFit!")
-            return True
-        else:
-            logger.error(f"❌ Cancellazione fallita: {response.status_code}")
-            logger.error(f"   Response: {response.text[:200]}")
-            return False
-    except Exception as e:
-        logger.error(f"❌ Errore cancel_booking_easyfit: {e}")
-        return False
-
+# =============================================================================
+# EASYFIT ASYNC CLIENT
+# =============================================================================
+
+class AsyncEasyFitClient:
+    """
+    Client EasyFit non bloccante condiviso da handler Telegram e
+    prenotazioni: login, calendario, prenotazione e cancellazione su un
+    httpx.AsyncClient con connessioni in pool, così una risposta lenta di
+    EasyFit non blocca le altre chat né gli altri spari.
+    Fa login solo quando serve e lo rifà in automatico se EasyFit risponde
+    401/403; il lock garantisce un solo login alla volta.
+    """
+
+    def __init__(self, max_age=EASYFIT_SESSION_MAX_AGE, max_connections=EASYFIT_ASYNC_MAX_CONNECTIONS):
+        self.max_age = max_age
+        self.max_connections = max_connections
+        self.session_id = None
+        self._client = None
+        self._lock = None
+        # (logged_in, logged_in_at, generation)
+        self._state = (False, 0.0, 0)
+        # Tempi di apertura connessione (DNS + TCP + TLS) misurati nel pre-riscaldamento
+        self.handshake_ms = deque(maxlen=50)
+        self.last_prewarm_at = None
+
+    def _get_client(self):
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=EASYFIT_BASE_URL,
+                timeout=15,
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                    keepalive_expiry=EASYFIT_KEEPALIVE_EXPIRY
+                )
+            )
+        return self._client
+
+    def _current(self):
+        logged_in, logged_in_at, generation = self._state
+        if not logged_in:
+            return False, generation
+        if self.max_age and time.monotonic() - logged_in_at > self.max_age:
+            return False, generation
+        return True, generation
+
+    async def login(self, stale_generation=None):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            # Un'altra coroutine ha già rifatto login mentre aspettavamo il lock
+            logged_in, generation = self._current()
+            if logged_in and stale_generation is not None and generation != stale_generation:
+                return True
+            try:
+                logger.info("🔐 Login EasyFit (async)...")
+                client = self._get_client()
+                client.cookies.clear()
+                headers, payload = easyfit_login_request()
+                response = await client.post("/login", json=payload, headers=headers, timeout=10)
+                if response.status_code != 200:
+                    logger.error(f"❌ Login fallito: {response.status_code}")
+                    logger.error(f"   Response: {response.text[:200]}")
+                    return False
+                self.session_id = response.json().get('sessionId')
+                logger.info(f"✅ Login OK! SessionID: {self.session_id[:20] if self.session_id else 'N/A'}...")
+                self._state = (True, time.monotonic(), self._state[2] + 1)
+                return True
+            except Exception as e:
+                logger.error(f"❌ Errore login: {e}")
+                return False
+
+    async def ensure(self):
+        """Ritorna il client con una sessione valida (login se serve), None se il login fallisce"""
+        logged_in, generation = self._current()
+        if not logged_in:
+            logged_in = await self.login(generation)
+        return self if logged_in else None
+
+    async def _request(self, method, url, **kwargs):
+        logged_in, generation = self._current()
+        if not logged_in:
+            if not await self.login(generation):
+                raise EasyFitLoginError("login EasyFit fallito")
+            generation = self._state[2]
+        response = await self._get_client().request(method, url, **kwargs)
+        if response.status_code in (401, 403):
+            logger.warning(f"🔑 Sessione EasyFit scaduta ({response.status_code}), rifaccio login...")
+            if await self.login(generation):
+                response = await self._get_client().request(method, url, **kwargs)
+        return response
+
+    async def get_calendar_courses(self, start_date, end_date, force_refresh=False):
+        try:
+            logger.info(f"📅 Range: {start_date} → {end_date}")
+            if not force_refresh:
+                cached = calendar_cache.get(start_date, end_date)
+                if cached is not None:
+                    logger.info(f"📦 Calendario dalla cache: {len(cached)} lezioni")
+                    return cached
+            response = await self._request(
+                'GET', "/nox/public/v2/bookableitems/courses/with-canceled",
+                params=calendar_params(start_date, end_date), headers=CALENDAR_HEADERS, timeout=15
+            )
+            courses = parse_calendar_response(response)
+            if response.status_code == 200:
+                calendar_cache.put(start_date, end_date, courses)
+            return courses
+        except Exception as e:
+            logger.error(f"❌ Errore get_calendar_courses: {e}")
+            return []
+
+    async def get_day_courses(self, class_date):
+        """Calendario di un singolo giorno, sempre fresco (hot path di prenotazione)"""
+        target_date = datetime.strptime(class_date, '%Y-%m-%d')
+        start_date = target_date.strftime('%Y-%m-%d')
+        end_date = (target_date + timedelta(days=1)).strftime('%Y-%m-%d')
+        return await self.get_calendar_courses(start_date, end_date, force_refresh=True)
+
+    async def find_course_id(self, class_name, class_date, class_time):
+        try:
+            index = CalendarIndex(await self.get_day_courses(class_date))
+            return match_course_id(index, class_name, class_date, class_time)
+        except Exception as e:
+            logger.error(f"❌ Errore find_course_id: {e}")
+            return None
+
+    async def book_course(self, course_appointment_id, try_waitlist=True, burst_seconds=0):
+        """
+        Prenota la lezione; con burst_seconds > 0 ripete il tentativo finché
+        EasyFit risponde "non ancora prenotabile"; passa alla lista d'attesa solo
+        se la lezione è piena o l'errore non è riconosciuto.
+        Ritorna (success, status, response, tentativi).
+        """
+        attempts = []
+        try:
+            logger.info(f"📝 Prenotazione ID: {course_appointment_id}")
+            url = "/nox/v1/calendar/bookcourse"
+            deadline = time.monotonic() + burst_seconds
+            while True:
+                started = time.monotonic()
+                response = await self._request(
+                    'POST', url, json=booking_payload(course_appointment_id), headers=BOOKING_HEADERS, timeout=10
+                )
+                latency_ms = (time.monotonic() - started) * 1000
+                if response.status_code == 200:
+                    attempts.append(BookingAttempt(response.status_code, latency_ms, 'ok'))
+                    log_booking_attempts(attempts)
+                    logger.info(f"✅ PRENOTATO!")
+                    return True, "completed", response.json(), attempts
+                kind, result = booking_rejection_result(response, deadline)
+                attempts.append(BookingAttempt(response.status_code, latency_ms, kind))
+                if result != 'retry':
+                    break
+                await asyncio.sleep(BOOKING_BURST_INTERVAL_MS / 1000)
+            log_booking_attempts(attempts)
+            logger.info(f"⚠️ Prenotazione normale fallita: {response.status_code} ({attempts[-1].kind})")
+            logger.info(f"   Response: {response.text[:300]}")
+            if result == 'completed':
+                return True, "completed", None, attempts
+            if result != 'waitlist':
+                return False, result, None, attempts
+            if try_waitlist:
+                logger.info(f"⏳ Provo lista d'attesa...")
+                waitlist_response = await self._request(
+                    'POST', url, json=booking_payload(course_appointment_id, "WAITING_LIST"),
+                    headers=BOOKING_HEADERS, timeout=10
+                )
+                if waitlist_response.status_code == 200:
+                    logger.info(f"✅ IN LISTA D'ATTESA!")
+                    return True, "waitlisted", waitlist_response.json(), attempts
+                return False, waitlist_failure_status(waitlist_response), None, attempts
+            return False, "full", None, attempts
+        except Exception as e:
+            logger.error(f"❌ Errore book_course: {e}")
+            return False, "error", None, attempts
+
+    async def cancel_booking(self, easyfit_booking_id):
+        try:
+            logger.info(f"🗑️ Cancellazione prenotazione EasyFit ID: {easyfit_booking_id}")
+            response = await self._request(
+                'DELETE', f"/v1/aggregated/calendaritems/easyfit:{easyfit_booking_id}",
+                headers=CANCEL_HEADERS, timeout=10
+            )
+            if response.status_code == 200:
+                logger.info("✅ Prenotazione cancellata su EasyFit!")
+                return True
+            logger.error(f"❌ Cancellazione fallita: {response.status_code}")
+            logger.error(f"   Response: {response.text[:200]}")
+            return False
+        except Exception as e:
+            logger.error(f"❌ Errore cancel_booking: {e}")
+            return False
+
+    async def prewarm(self, connections=EASYFIT_PREWARM_CONNECTIONS):
+        """
+        Apre in anticipo `connections` connessioni keep-alive verso EasyFit
+        nel pool del client (richieste HEAD concorrenti), così la POST di
+        prenotazione parte su un socket già pronto. Ritorna quante richieste
+        sono andate a buon fine.
+        """
+        if await self.ensure() is None:
+            return 0
+        client = self._get_client()
+
+        async def connect():
+            started = time.monotonic()
+            try:
+                await client.head("/", timeout=5)
+            except Exception as e:
+                logger.warning(f"⚠️ Pre-riscaldamento connessione fallito: {e}")
+                return None
+            return (time.monotonic() - started) * 1000
+
+        results = await asyncio.gather(*(connect() for _ in range(min(connections, self.max_connections))))
+        timings = [t for t in results if t is not None]
+        self.handshake_ms.extend(timings)
+        self.last_prewarm_at = datetime.now(pytz.utc)
+        if timings:
+            logger.info(f"🔥 Aperte {len(timings)} connessioni EasyFit (handshake ms: {', '.join(f'{t:.0f}' for t in timings)})")
+        return len(timings)
+
+    def connection_metrics(self):
+        logged_in, _ = self._current()
+        # Stima senza leggere il pool interno di httpx: calde se pre-aperte da meno di keepalive_expiry
+        warm = (
+            self._client is not None and self.last_prewarm_at is not None
+            and (datetime.now(pytz.utc) - self.last_prewarm_at).total_seconds() < EASYFIT_KEEPALIVE_EXPIRY
+        )
+        handshakes = list(self.handshake_ms)
+        return {
+            'logged_in': logged_in,
+            'state': 'warm' if warm else 'cold',
+            'pool_size': self.max_connections,
+            'keepalive_expiry': EASYFIT_KEEPALIVE_EXPIRY,
+            'last_prewarm_at': self.last_prewarm_at.isoformat() if self.last_prewarm_at else None,
+            'handshake_ms_last': round(handshakes[-1], 1) if handshakes else None,
+            'handshake_ms_avg': round(sum(handshakes) / len(handshakes), 1) if handshakes else None
+        }
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+# Client EasyFit asincrono globale (handler e prenotazioni)
+easyfit_async = AsyncEasyFitClient()
+
 
 # =============================================================================
 # TELEGRAM BOT FUNCTIONS
@@ -338,10 +1739,11 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"🤖 Cosa posso fare:\n"
         f"• Prenotare lezioni 72 ore prima automaticamente\n"
         f"• Gestire automaticamente la lista d'attesa\n"
-        f"• Attivo dalle 8 alle 21 ogni giorno\n\n"
+        f"• Prenotare all'apertura, a qualsiasi ora\n\n"
         f"📋 Comandi disponibili:\n"
         f"/prenota - Programma una nuova prenotazione\n"
         f"/lista - Vedi prenotazioni programmate\n"
+        f"/storico - Vedi le lezioni passate\n"
         f"/cancella - Cancella prenotazione\n"
         f"/help - Guida completa"
     )
@@ -350,8 +1752,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def prenota(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🔍 Recupero lezioni disponibili...\n⏳ Attendi qualche secondo...")
     try:
-        session = easyfit_login()
-        if not session:
+        client = await easyfit_async.ensure()
+        if not client:
             await update.message.reply_text(
                 "❌ Errore login EasyFit.\n"
                 "Riprova tra qualche minuto."
@@ -361,7 +1763,7 @@ async def prenota(update: Update, context: ContextTypes.DEFAULT_TYPE):
         today = datetime.now(timezone.utc)
         start_date = today.strftime('%Y-%m-%d')
         end_date = (today + timedelta(days=7)).strftime('%Y-%m-%d')
-        courses = get_calendar_courses(session, start_date, end_date)
+        courses = await client.get_calendar_courses(start_date, end_date)
         if not courses:
             await update.message.reply_text(
                 "❌ Nessuna lezione disponibile nei prossimi 7 giorni.\n"
@@ -396,6 +1798,7 @@ async def prenota(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
             return
         context.user_data['courses'] = future_courses
+        context.user_data['calendar_index'] = CalendarIndex(future_courses)
         courses_by_name = {}
         for course in future_courses:
             name = course.get('name', 'Sconosciuto')
@@ -472,9 +1875,11 @@ async def date_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     courses_by_date = context.user_data.get('courses_by_date', {})
     date_slots = courses_by_date.get(date_str, [])
     context.user_data['date_slots'] = date_slots
-    all_courses = context.user_data.get('courses', [])
     course_name = context.user_data.get('class_name', '')
-    matching_courses = [c for c in all_courses if c.get('name') == course_name]
+    calendar_index = context.user_data.get('calendar_index')
+    if calendar_index is None:
+        calendar_index = CalendarIndex(context.user_data.get('courses', []))
+        context.user_data['calendar_index'] = calendar_index
     keyboard = []
     from datetime import timezone
     now_utc = datetime.now(timezone.utc)
@@ -497,25 +1902,13 @@ async def date_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     lastname = instructor.get('lastname', '')
                     if firstname or lastname:
                         instructor_name = f" • {firstname} {lastname}".strip()
-            course_for_slot = None
-            for course in matching_courses:
-                for course_slot in course.get('slots', []):
-                    if course_slot.get('startDateTime') == start_datetime_str:
-                        course_for_slot = course
-                        break
-                if course_for_slot:
-                    break
-            if course_for_slot:
-                booked = course_for_slot.get('bookedParticipants', 0)
-                max_part = course_for_slot.get('maxParticipants', 0)
-                wait_active = course_for_slot.get('waitingListActive', False)
-                wait_count = course_for_slot.get('waitingListParticipants', 0)
-                max_wait = course_for_slot.get('maxWaitingListParticipants', 0)
+            slot_info = calendar_index.at_start(start_datetime_str, course_name)
+            if slot_info:
                 if hours_until > 72:
                     status = "🟢 Prenotabile"
-                elif booked < max_part:
+                elif slot_info.booked < slot_info.max_participants:
                     status = "✅ Posti liberi"
-                elif wait_active and wait_count < max_wait:
+                elif slot_info.waiting_list_active and slot_info.waiting_list_participants < slot_info.max_waiting_list_participants:
                     status = "⏳ Lista d'attesa"
                 else:
                     status = "🚫 Completa"
@@ -535,377 +1928,1239 @@ async def date_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-async def time_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    query = update.callback_query
-    await query.answer()
-    time_str = query.data.split('_')[1]
-    context.user_data['time'] = time_str
+async def time_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    time_str = query.data.split('_')[1]
+    context.user_data['time'] = time_str
+
+    class_datetime_naive = datetime.strptime(
+        f"{context.user_data['date']} {time_str}",
+        '%Y-%m-%d %H:%M'
+    )
+    class_datetime_rome = ROME_TZ.localize(class_datetime_naive)
+    class_start_utc = class_datetime_rome.astimezone(pytz.utc)
+    booking_datetime_rome = class_datetime_rome - timedelta(hours=72)
+    booking_datetime_utc = booking_datetime_rome.astimezone(pytz.utc)
+
+    # Pre-risoluzione: l'ID lezione è già nel calendario scaricato da /prenota
+    course_appointment_id = None
+    calendar_index = context.user_data.get('calendar_index')
+    if calendar_index is not None:
+        slot_info = calendar_index.find(context.user_data['class_name'], context.user_data['date'], time_str)
+        if slot_info:
+            course_appointment_id = slot_info.course_id
+
+    try:
+        booking_id = await async_db.insert_booking(
+            str(query.from_user.id),
+            context.user_data['class_name'],
+            context.user_data['date'],
+            time_str,
+            class_start_utc,
+            booking_datetime_utc,
+            course_appointment_id
+        )
+        arm_booking_timer(booking_id, booking_datetime_utc)
+        date_obj = datetime.strptime(context.user_data['date'], '%Y-%m-%d')
+        day_name = ['Lunedì', 'Martedì', 'Mercoledì', 'Giovedì', 'Venerdì', 'Sabato', 'Domenica'][date_obj.weekday()]
+        await query.edit_message_text(
+            f"✅ PRENOTAZIONE PROGRAMMATA!\n\n"
+            f"📚 Lezione: {context.user_data['class_name']}\n"
+            f"📅 Data: {day_name} {date_obj.strftime('%d/%m/%Y')}\n"
+            f"🕐 Orario: {time_str}\n\n"
+            f"⏰ Prenoterò automaticamente:\n"
+            f"   {booking_datetime_rome.strftime('%d/%m/%Y alle %H:%M')} (ora italiana)\n"
+            f"   (72 ore prima)\n\n"
+            f"Usa /lista per verificare!\n\n"
+            f"ID Prenotazione: #{booking_id}"
+        )
+    except Exception as e:
+        logger.error(f"Errore salvataggio database: {e}")
+        await query.edit_message_text(
+            "❌ Errore nel salvare la prenotazione. Riprova."
+        )
+
+
+LISTA_SECTIONS = {
+    'pending': "⏳ PROGRAMMATE:",
+    'completed': "✅ PRENOTATE:",
+    'waitlisted': "📋 LISTA D'ATTESA:",
+}
+
+WEEKDAY_NAMES = ['Lun', 'Mar', 'Mer', 'Gio', 'Ven', 'Sab', 'Dom']
+
+
+def split_message(text, limit=TELEGRAM_MESSAGE_LIMIT):
+    """
+    Divide un testo in parti sotto il limite di Telegram, spezzando
+    preferibilmente tra paragrafi, poi tra righe, e solo in ultimo a metà riga.
+    """
+    chunks = []
+    while len(text) > limit:
+        cut = text.rfind('\n\n', 0, limit)
+        if cut <= 0:
+            cut = text.rfind('\n', 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunk = text[:cut].rstrip('\n')
+        if chunk:
+            chunks.append(chunk)
+        text = text[cut:].lstrip('\n')
+    if text:
+        chunks.append(text)
+    return chunks
+
+
+def format_lista_booking(booking):
+    booking_id, class_name, class_start_utc, booking_date, status, _ = booking
+    class_start = class_start_utc.astimezone(ROME_TZ)
+    day_name = WEEKDAY_NAMES[class_start.weekday()]
+    text = f"#{booking_id} - {class_name}\n"
+    text += f"   📅 {day_name} {class_start.strftime('%d/%m/%Y')} ore {class_start.strftime('%H:%M')}\n"
+    if status == 'pending':
+        if booking_date.tzinfo is None:
+            booking_date = booking_date.replace(tzinfo=pytz.utc)
+        booking_date_ita = booking_date.astimezone(ROME_TZ)
+        text += f"   ⏰ Prenoterò: {booking_date_ita.strftime('%d/%m/%Y %H:%M')} (ora italiana)\n"
+    return text + "\n"
+
+
+def lista_keyboard(page, pages):
+    if pages <= 1:
+        return None
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("⬅️ Precedenti", callback_data=f'lista_{page - 1}'))
+    if page < pages - 1:
+        buttons.append(InlineKeyboardButton("Successive ➡️", callback_data=f'lista_{page + 1}'))
+    return InlineKeyboardMarkup([buttons])
+
+
+async def render_lista_page(user_id, page):
+    """Ritorna (parti del messaggio, tastiera) per una pagina di /lista"""
+    bookings = await async_db.fetch_user_bookings(user_id, LISTA_PAGE_SIZE, page * LISTA_PAGE_SIZE)
+    if not bookings and page > 0:
+        # La pagina non esiste più (es. prenotazioni cancellate nel frattempo)
+        page = 0
+        bookings = await async_db.fetch_user_bookings(user_id, LISTA_PAGE_SIZE, 0)
+    if not bookings:
+        return [
+            "📋 Non hai prenotazioni future.\n\n"
+            "Usa /prenota per programmarne una!"
+        ], None
+    total = bookings[0][5]
+    pages = (total + LISTA_PAGE_SIZE - 1) // LISTA_PAGE_SIZE
+    message = "📋 LE TUE PRENOTAZIONI"
+    if pages > 1:
+        message += f" ({page + 1}/{pages})"
+    message += ":\n\n"
+    section = None
+    for booking in bookings:
+        status = booking[4]
+        if status != section:
+            section = status
+            message += LISTA_SECTIONS[status] + "\n"
+        message += format_lista_booking(booking)
+    message += "💡 Usa /cancella <ID> per cancellare"
+    return split_message(message), lista_keyboard(page, pages)
+
+
+async def lista(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    try:
+        chunks, reply_markup = await render_lista_page(user_id, 0)
+        for index, chunk in enumerate(chunks):
+            last = index == len(chunks) - 1
+            await update.message.reply_text(chunk, reply_markup=reply_markup if last else None)
+    except Exception as e:
+        logger.error(f"Errore recupero prenotazioni: {e}")
+        await update.message.reply_text("❌ Errore nel recuperare le prenotazioni.")
+
+
+async def lista_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    user_id = str(update.effective_user.id)
+    page = int(query.data.split('_')[1])
+    try:
+        chunks, reply_markup = await render_lista_page(user_id, page)
+        first_markup = reply_markup if len(chunks) == 1 else None
+        await query.edit_message_text(chunks[0], reply_markup=first_markup)
+        for index, chunk in enumerate(chunks[1:], start=1):
+            last = index == len(chunks) - 1
+            await query.message.reply_text(chunk, reply_markup=reply_markup if last else None)
+    except Exception as e:
+        logger.error(f"Errore recupero prenotazioni: {e}")
+        await query.message.reply_text("❌ Errore nel recuperare le prenotazioni.")
+
+
+def history_outcome(status, easyfit_booking_id, error_code):
+    if status == 'waitlisted':
+        return "📋 Lista d'attesa"
+    if status == 'pending':
+        return "⏭️ Non eseguita"
+    if error_code:
+        return f"❌ Non prenotata ({error_code})"
+    if easyfit_booking_id:
+        return "✅ Prenotata"
+    return "✔️ Completata"
+
+
+async def storico(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    try:
+        history = await async_db.fetch_user_history(user_id)
+        if not history:
+            await update.message.reply_text("📜 Nessuna lezione passata.")
+            return
+        message = "📜 LE TUE ULTIME LEZIONI:\n\n"
+        for booking_id, class_name, class_start_utc, status, easyfit_booking_id, error_code in history:
+            class_start = class_start_utc.astimezone(ROME_TZ)
+            day_name = WEEKDAY_NAMES[class_start.weekday()]
+            message += f"#{booking_id} - {class_name}\n"
+            message += f"   📅 {day_name} {class_start.strftime('%d/%m/%Y')} ore {class_start.strftime('%H:%M')}\n"
+            message += f"   {history_outcome(status, easyfit_booking_id, error_code)}\n\n"
+        for chunk in split_message(message.rstrip()):
+            await update.message.reply_text(chunk)
+    except Exception as e:
+        logger.error(f"Errore recupero storico: {e}")
+        await update.message.reply_text("❌ Errore nel recuperare lo storico.")
+
+
+async def cancella(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = str(update.effective_user.id)
+    if not context.args:
+        await update.message.reply_text(
+            "❌ Devi specificare l'ID della prenotazione.\n\n"
+            "Esempio: /cancella 5\n\n"
+            "Usa /lista per vedere gli ID."
+        )
+        return
+    try:
+        booking_id = int(context.args[0])
+    except ValueError:
+        await update.message.reply_text("❌ ID non valido. Deve essere un numero.")
+        return
+    try:
+        result = await async_db.fetch_user_booking(booking_id, user_id)
+        if not result:
+            await update.message.reply_text(f"❌ Prenotazione #{booking_id} non trovata.")
+            return
+        class_name, class_date, class_time, status, easyfit_booking_id = result
+        if status == 'in_progress':
+            await update.message.reply_text(
+                f"⏳ Prenotazione #{booking_id} in esecuzione proprio ora.\n\n"
+                f"Riprova tra qualche istante con /cancella {booking_id}."
+            )
+            return
+        if status == 'pending':
+            await async_db.delete_booking(booking_id)
+            disarm_booking_timer(booking_id)
+            await update.message.reply_text(
+                f"✅ PRENOTAZIONE PROGRAMMATA CANCELLATA\n\n"
+                f"#{booking_id} - {class_name}\n"
+                f"📅 {class_date} ore {class_time}\n\n"
+                f"ℹ️ La prenotazione non era ancora stata eseguita.\n"
+                f"Rimossa solo dal database del bot."
+            )
+            return
+        if status in ['completed', 'waitlisted']:
+            if not easyfit_booking_id:
+                await update.message.reply_text(
+                    f"⚠️ CANCELLAZIONE PARZIALE\n\n"
+                    f"#{booking_id} - {class_name}\n"
+                    f"📅 {class_date} ore {class_time}\n\n"
+                    f"❌ Non ho l'ID della prenotazione su EasyFit.\n"
+                    f"Cancellata solo dal bot.\n\n"
+                    f"⚠️ Devi cancellare manualmente dall'app EasyFit!"
+                )
+                await async_db.delete_booking(booking_id)
+                return
+            await update.message.reply_text("🔄 Cancellazione in corso...\n⏳ Attendi...")
+            client = await easyfit_async.ensure()
+            if not client:
+                await update.message.reply_text(
+                    f"❌ ERRORE LOGIN EASYFIT\n\n"
+                    f"Non riesco a connettermi a EasyFit.\n\n"
+                    f"💡 Prova:\n"
+                    f"1. Cancella manualmente dall'app\n"
+                    f"2. Riprova tra qualche minuto"
+                )
+                return
+            success = await client.cancel_booking(easyfit_booking_id)
+            if success:
+                await async_db.delete_booking(booking_id)
+                await update.message.reply_text(
+                    f"✅ PRENOTAZIONE CANCELLATA!\n\n"
+                    f"#{booking_id} - {class_name}\n"
+                    f"📅 {class_date} ore {class_time}\n\n"
+                    f"✅ Cancellata su EasyFit\n"
+                    f"✅ Rimossa dal bot\n\n"
+                    f"Il posto è ora disponibile per altri!"
+                )
+            else:
+                await update.message.reply_text(
+                    f"⚠️ CANCELLAZIONE FALLITA\n\n"
+                    f"#{booking_id} - {class_name}\n"
+                    f"📅 {class_date} ore {class_time}\n\n"
+                    f"❌ Errore nella cancellazione su EasyFit.\n\n"
+                    f"💡 Prova a cancellare manualmente dall'app.\n"
+                    f"La prenotazione rimane nel database del bot."
+                )
+            return
+        await update.message.reply_text(
+            f"⚠️ Status prenotazione sconosciuto: {status}\n"
+            f"Contatta l'amministratore."
+        )
+    except Exception as e:
+        logger.error(f"Errore cancellazione: {e}")
+        await update.message.reply_text("❌ Errore nella cancellazione.")
+
+
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "📖 GUIDA EASYFIT BOT\n\n"
+        "🤖 Cosa fa questo bot:\n"
+        "Prenota automaticamente le tue lezioni EasyFit "
+        "esattamente 72 ore prima dell'inizio.\n\n"
+        "📋 COMANDI:\n\n"
+        "/prenota - Programma una nuova prenotazione\n"
+        "   Mostra calendario REALE EasyFit.\n"
+        "   Scegli lezione, giorno e orario.\n"
+        "   Il bot prenoterà automaticamente 72h prima.\n\n"
+        "/lista - Vedi tutte le prenotazioni\n"
+        "   Mostra cosa hai in programma.\n\n"
+        "/storico - Vedi le lezioni passate\n"
+        "   Ultime lezioni e com'è andata la prenotazione.\n\n"
+        "/cancella <ID> - Cancella una prenotazione\n"
+        "   Esempio: /cancella 5\n"
+        "   ⚠️ Se già prenotata, cancella anche su EasyFit!\n\n"
+        "⏰ ORARI:\n"
+        "Il bot prenota nel momento esatto in cui si apre\n"
+        "la prenotazione, a qualsiasi ora del giorno.\n\n"
+        "📋 LISTA D'ATTESA:\n"
+        "Se una lezione è piena, il bot proverà automaticamente\n"
+        "ad inserirti in lista d'attesa!\n\n"
+        "❓ Problemi? Usa /lista per controllare lo stato."
+    )
+
+
+# =============================================================================
+# SCHEDULER FUNCTION
+# =============================================================================
+
+# Scheduler globale (creato in post_init, gira sull'event loop del bot)
+scheduler = None
+# Applicazione Telegram (impostata in post_init), usata per avvisare gli utenti
+bot_application = None
+
+# Timer di precisione: booking_id -> orario di sparo previsto (UTC)
+armed_bookings = {}
+# Prenotazioni in esecuzione in questo processo
+inflight_bookings = set()
+inflight_lock = Lock()
+# Ultimi offset di sparo misurati (ms, positivo = in ritardo)
+fire_offsets_ms = deque(maxlen=100)
+
+
+def in_quiet_hours(hour):
+    """True se l'ora italiana cade nelle ore di silenzio (QUIET_HOURS), anche a cavallo della mezzanotte"""
+    if QUIET_HOURS_START is None:
+        return False
+    if QUIET_HOURS_START <= QUIET_HOURS_END:
+        return QUIET_HOURS_START <= hour < QUIET_HOURS_END
+    return hour >= QUIET_HOURS_START or hour < QUIET_HOURS_END
+
+
+def booking_fire_time(booking_date):
+    """
+    Orario di sparo di una prenotazione (UTC): esattamente booking_date, a
+    qualsiasi ora, oppure la fine delle ore di silenzio se ci cade dentro.
+    """
+    booking_utc = booking_date.replace(tzinfo=pytz.utc) if booking_date.tzinfo is None else booking_date.astimezone(pytz.utc)
+    booking_ita = booking_utc.astimezone(ROME_TZ)
+    if not in_quiet_hours(booking_ita.hour):
+        return booking_utc
+    opening_day = booking_ita.date() if booking_ita.hour < QUIET_HOURS_END else booking_ita.date() + timedelta(days=1)
+    opening = ROME_TZ.localize(datetime.combine(opening_day, datetime.min.time()).replace(hour=QUIET_HOURS_END))
+    return opening.astimezone(pytz.utc)
+
+
+async def sleep_until(target_utc):
+    """Attende fino a target_utc senza bloccare l'event loop: sleep normale, poi passi da 1 ms"""
+    while True:
+        remaining = (target_utc - datetime.now(pytz.utc)).total_seconds()
+        if remaining <= 0:
+            return
+        await asyncio.sleep(remaining - 0.02 if remaining > 0.05 else 0.001)
+
+
+def record_fire_offset(booking_id, fire_at, posted_at):
+    offset_ms = (posted_at - fire_at).total_seconds() * 1000
+    fire_offsets_ms.append(offset_ms)
+    logger.info(f"⏱️ Prenotazione #{booking_id}: offset sparo {offset_ms:+.0f} ms")
+    return offset_ms
+
+
+def claim_local_booking(booking_id):
+    """Segna la prenotazione come in esecuzione in questo processo; False se lo è già"""
+    with inflight_lock:
+        if booking_id in inflight_bookings:
+            return False
+        inflight_bookings.add(booking_id)
+        armed_bookings.pop(booking_id, None)
+        return True
+
+
+def release_local_booking(booking_id):
+    with inflight_lock:
+        inflight_bookings.discard(booking_id)
+
+
+BookingOutcome = namedtuple('BookingOutcome', [
+    'booking_id', 'status', 'easyfit_booking_id', 'result', 'latency_ms', 'offset_ms', 'attempts'
+])
+
+
+BOOKING_FAILURE_REASONS = {
+    'full': "lezione piena",
+    'waitlist_unavailable': "lista d'attesa non disponibile",
+    'not_open': "prenotazioni non ancora aperte",
+    'error': "errore EasyFit",
+}
+
+
+async def resolve_booking_course(client, booking, day_indexes):
+    """ID lezione della prenotazione: quello pre-risolto o cercato sul calendario del giorno"""
+    booking_id, user_id, class_name, class_date, class_time, booking_date, course_appointment_id = booking
+    if course_appointment_id:
+        logger.info(f"⚡ ID lezione pre-risolto: {course_appointment_id}")
+        return course_appointment_id
+    class_date_str = str(class_date)
+    if class_date_str not in day_indexes:
+        day_indexes[class_date_str] = CalendarIndex(await client.get_day_courses(class_date_str))
+    return match_course_id(day_indexes[class_date_str], class_name, class_date_str, class_time)
+
+
+async def execute_booking(client, booking_id, course_appointment_id, fire_at):
+    """
+    Parte di rete di una prenotazione, senza accessi al DB: attende
+    l'orario di sparo e invia il bookcourse. Ritorna un BookingOutcome.
+    """
+    if not course_appointment_id:
+        return BookingOutcome(booking_id, 'completed', None, 'not_found', 0.0, None, [])
+    await sleep_until(fire_at)
+    offset_ms = record_fire_offset(booking_id, fire_at, datetime.now(pytz.utc))
+    started = time.monotonic()
+    success, status, response, attempts = await client.book_course(
+        course_appointment_id, burst_seconds=BOOKING_BURST_SECONDS
+    )
+    latency_ms = (time.monotonic() - started) * 1000
+    logger.info(f"⏱️ Prenotazione #{booking_id}: {status} in {latency_ms:.0f} ms ({len(attempts)} tentativi)")
+    if success:
+        easyfit_booking_id = None
+        if response and isinstance(response, dict):
+            easyfit_booking_id = response.get('id')
+        return BookingOutcome(booking_id, status, easyfit_booking_id, status, latency_ms, offset_ms, attempts)
+    return BookingOutcome(booking_id, 'completed', None, status, latency_ms, offset_ms, attempts)
+
+
+def outcome_confirmed(outcome):
+    """True se EasyFit ha già confermato la prenotazione (o la lista d'attesa)"""
+    return outcome.easyfit_booking_id is not None or outcome.result in ('completed', 'waitlisted')
+
+
+def log_booking_outcome(outcome):
+    if outcome.result == 'not_found':
+        logger.warning(f"⚠️ Prenotazione #{outcome.booking_id} - Lezione non trovata")
+    elif outcome_confirmed(outcome):
+        logger.info(f"💾 Salvato easyfit_booking_id: {outcome.easyfit_booking_id}")
+        logger.info(f"🎉 Prenotazione #{outcome.booking_id} completata - Status: {outcome.status}")
+    else:
+        logger.error(f"❌ Prenotazione #{outcome.booking_id} fallita - Status: {outcome.result}")
+
+
+async def save_booking_outcomes(outcomes):
+    """Scrive e committa un batch di esiti; ritorna gli ID effettivamente salvati"""
+    saved = await async_db.save_booking_outcomes(outcomes)
+    for outcome in outcomes:
+        if outcome.booking_id in saved:
+            log_booking_outcome(outcome)
+        else:
+            logger.warning(f"⚠️ Prenotazione #{outcome.booking_id}: lease perso, esito non salvato")
+    return saved
+
+
+async def notify_booking_outcome(application, booking, outcome):
+    """Avvisa l'utente su Telegram dell'esito di una prenotazione già salvata"""
+    if application is None or booking is None:
+        return
+    booking_id, user_id, class_name, class_date, class_time, _, _ = booking
+    if outcome.result == 'not_found':
+        header = "⚠️ LEZIONE NON TROVATA\n\nNon l'ho trovata sul calendario EasyFit, prenotazione non effettuata."
+    elif outcome.result == 'completed':
+        header = "🎉 PRENOTAZIONE EFFETTUATA!"
+    elif outcome.result == 'waitlisted':
+        header = "📋 SEI IN LISTA D'ATTESA"
+    else:
+        header = f"❌ PRENOTAZIONE NON RIUSCITA\n\nMotivo: {BOOKING_FAILURE_REASONS.get(outcome.result, outcome.result)}"
+    date_obj = datetime.strptime(str(class_date), '%Y-%m-%d')
+    text = (
+        f"{header}\n\n"
+        f"📚 Lezione: {class_name}\n"
+        f"📅 Data: {WEEKDAY_NAMES[date_obj.weekday()]} {date_obj.strftime('%d/%m/%Y')}\n"
+        f"🕐 Orario: {class_time}\n\n"
+        f"ID Prenotazione: #{booking_id}"
+    )
+    try:
+        await application.bot.send_message(chat_id=int(user_id), text=text)
+    except Exception as e:
+        logger.warning(f"⚠️ Notifica prenotazione #{booking_id} non inviata: {e}")
+
+
+class OutcomeWriter:
+    """
+    Accumula gli esiti delle prenotazioni e li scrive a batch di
+    BOOKING_WRITE_BATCH_SIZE, poi avvisa gli utenti delle righe salvate.
+    Con BOOKING_FLUSH_ON_CONFIRM un batch che contiene un ID prenotazione
+    EasyFit viene scritto subito, così un crash non perde una prenotazione
+    già confermata.
+    Se la scrittura fallisce, gli esiti confermati vengono riscritti fino a
+    confirmed_retries volte; quelli ancora non salvati finiscono in `kept`:
+    il chiamante non deve rimetterli pending (un nuovo bookcourse
+    perderebbe l'ID EasyFit), restano in_progress fino alla scadenza del lease.
+    """
+
+    def __init__(self, application, bookings, batch_size=BOOKING_WRITE_BATCH_SIZE, flush_on_confirm=BOOKING_FLUSH_ON_CONFIRM,
+                 confirmed_retries=BOOKING_CONFIRMED_WRITE_RETRIES):
+        self.application = application
+        self.bookings = {booking[0]: booking for booking in bookings}
+        self.batch_size = max(1, batch_size)
+        self.flush_on_confirm = flush_on_confirm
+        self.confirmed_retries = confirmed_retries
+        self.pending = []
+        self.saved = set()
+        self.kept = set()
+
+    async def add(self, outcome):
+        self.pending.append(outcome)
+        confirmed = outcome.easyfit_booking_id is not None
+        if len(self.pending) >= self.batch_size or (confirmed and self.flush_on_confirm):
+            await self.flush()
+
+    async def flush(self):
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        try:
+            saved = await save_booking_outcomes(batch)
+        except Exception as save_error:
+            ids = ', '.join(f"#{outcome.booking_id}" for outcome in batch)
+            logger.error(f"❌ Errore salvataggio prenotazioni {ids}: {save_error}")
+            saved = await self._retry_confirmed([outcome for outcome in batch if outcome_confirmed(outcome)])
+        self.saved |= saved
+        await asyncio.gather(*(
+            notify_booking_outcome(self.application, self.bookings.get(outcome.booking_id), outcome)
+            for outcome in batch if outcome.booking_id in saved
+        ))
+
+    async def _retry_confirmed(self, outcomes):
+        """Riscrive gli esiti già confermati su EasyFit; ritorna gli ID salvati"""
+        for attempt in range(self.confirmed_retries):
+            if not outcomes:
+                break
+            await asyncio.sleep(2 ** attempt)
+            try:
+                return await save_booking_outcomes(outcomes)
+            except Exception as save_error:
+                logger.error(f"❌ Salvataggio esiti confermati, tentativo {attempt + 1}/{self.confirmed_retries}: {save_error}")
+        for outcome in outcomes:
+            self.kept.add(outcome.booking_id)
+            logger.error(
+                f"🚨 Prenotazione #{outcome.booking_id} confermata su EasyFit (ID {outcome.easyfit_booking_id}) "
+                f"ma non salvata: resta in_progress fino alla scadenza del lease"
+            )
+        return set()
+
+
+class LeaseKeeper:
+    """
+    Rinnova il lease delle prenotazioni prese in carico finché sono in
+    esecuzione, ogni terzo di BOOKING_LEASE_SECONDS. Burst, lista d'attesa
+    e nuovi login possono durare più del lease: senza rinnovo un'altra
+    istanza riprenderebbe la riga e la prenoterebbe una seconda volta.
+    Le righe non più rinnovabili (esito già salvato o lease perso) escono
+    dal rinnovo.
+    """
+
+    def __init__(self, booking_ids, interval=max(1, BOOKING_LEASE_SECONDS / 3)):
+        self.booking_ids = set(booking_ids)
+        self.interval = interval
+        self.renewals = 0
+        self._task = None
+
+    async def _run(self):
+        while self.booking_ids:
+            await asyncio.sleep(self.interval)
+            try:
+                self.booking_ids &= await async_db.renew_booking_leases(self.booking_ids)
+                self.renewals += 1
+            except Exception as e:
+                logger.warning(f"⚠️ Rinnovo lease fallito: {e}")
+
+    async def __aenter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+
+async def run_bookings_concurrently(client, jobs):
+    """
+    Esegue in parallelo sull'event loop le prenotazioni (booking_id,
+    course_appointment_id, fire_at), al massimo BOOKING_CONCURRENCY alla volta.
+    Restituisce gli esiti man mano che arrivano; le prenotazioni finite in
+    errore restano pending.
+    """
+    if not jobs:
+        return
+    semaphore = asyncio.Semaphore(BOOKING_CONCURRENCY)
+
+    async def run(booking_id, course_appointment_id, fire_at):
+        try:
+            async with semaphore:
+                return await execute_booking(client, booking_id, course_appointment_id, fire_at)
+        except Exception as booking_error:
+            logger.error(f"❌ Errore processamento prenotazione #{booking_id}: {booking_error}")
+            return None
+        finally:
+            release_local_booking(booking_id)
+
+    for next_outcome in asyncio.as_completed([run(*job) for job in jobs]):
+        outcome = await next_outcome
+        if outcome is not None:
+            yield outcome
+
+
+async def book_claimed_bookings(application, bookings, now_utc):
+    """
+    Esegue prenotazioni già prese in carico: login, ID lezione, sparo
+    concorrente e scrittura degli esiti. Quelle non eseguite tornano pending;
+    quelle confermate su EasyFit ma non salvate restano in_progress.
+    """
+    from datetime import timezone
+    claimed = {booking[0] for booking in bookings}
+    writer = OutcomeWriter(application, bookings)
+    try:
+        async with LeaseKeeper(claimed):
+            client = await easyfit_async.ensure()
+            if not client:
+                logger.error("❌ Login fallito - salto controllo")
+                return
+            # Un solo fetch del calendario per ogni data di lezione del batch
+            day_indexes = {}
+            jobs = []
+            for booking in bookings:
+                booking_id, user_id, class_name, class_date, class_time, booking_date, _ = booking
+                if not claim_local_booking(booking_id):
+                    continue
+                logger.info(f"📝 PRENOTAZIONE #{booking_id}")
+                logger.info(f"   📚 {class_name}")
+                logger.info(f"   📅 {class_date} ore {class_time}")
+                delay = (now_utc - booking_date.replace(tzinfo=timezone.utc)).total_seconds() / 60
+                if delay > 5:
+                    logger.warning(f"   ⚠️ In ritardo di {int(delay)} minuti")
+                try:
+                    course_appointment_id = await resolve_booking_course(client, booking, day_indexes)
+                except Exception as booking_error:
+                    logger.error(f"❌ Errore processamento prenotazione #{booking_id}: {booking_error}")
+                    release_local_booking(booking_id)
+                    continue
+                jobs.append((booking_id, course_appointment_id, booking_fire_time(booking_date)))
+            async for outcome in run_bookings_concurrently(client, jobs):
+                await writer.add(outcome)
+            await writer.flush()
+    finally:
+        claimed -= writer.saved | writer.kept
+        if claimed:
+            # Prenotazioni prese ma non eseguite: tornano pending per il prossimo giro
+            try:
+                await async_db.release_booking_claims(claimed)
+            except Exception as release_error:
+                logger.error(f"❌ Errore rilascio prenotazioni: {release_error}")
+
+
+async def check_and_book(application):
+    """
+    Controlla e prenota lezioni.
+    Viene chiamato da run_sweep quando scade una prenotazione, a qualsiasi
+    ora tranne le eventuali ore di silenzio, quindi non serve un controllo
+    orario interno.
+    Fa da rete di sicurezza per i timer di precisione: salta le prenotazioni
+    che hanno già un timer armato o sono in esecuzione.
+    Le prenotazioni vengono prese in carico con un claim atomico, così più
+    istanze possono girare insieme senza prenotare due volte la stessa riga.
+    """
+    from datetime import timezone
+    now_utc = datetime.now(timezone.utc)
+
+    logger.info(f"🔍 CONTROLLO PRENOTAZIONI")
+    logger.info(f"⏰ Ora UTC: {now_utc.strftime('%Y-%m-%d %H:%M:%S')}")
+    logger.info(f"⏰ Ora ITA: {now_utc.astimezone(ROME_TZ).strftime('%Y-%m-%d %H:%M:%S')}")
+
+    try:
+        for booking_id, lease_owner in await async_db.recover_expired_leases():
+            logger.warning(f"♻️ Prenotazione #{booking_id}: lease di {lease_owner} scaduto, torna pending")
+        with inflight_lock:
+            local_ids = set(armed_bookings) | inflight_bookings
+        bookings_to_make = await async_db.claim_due_bookings(now_utc, local_ids)
+        logger.info(f"📋 Prese in carico {len(bookings_to_make)} prenotazioni da processare")
+        if bookings_to_make:
+            await book_claimed_bookings(application, bookings_to_make, now_utc)
+    except psycopg2.OperationalError as db_error:
+        logger.error(f"❌ Errore connessione DB: {db_error}")
+        logger.info("⏭️ Salto questo controllo, riproverò al prossimo giro")
+    except Exception as e:
+        logger.error(f"❌ Errore check_and_book: {e}")
+        import traceback
+        logger.error(traceback.format_exc())
+
+
+# =============================================================================
+# PRECISION BOOKING TIMERS
+# =============================================================================
+
+def arm_booking_timer(booking_id, booking_date):
+    """
+    Arma un timer di precisione per una prenotazione: il job parte
+    BOOKING_PREP_LEAD secondi prima per login e calendario, poi invia
+    il bookcourse esattamente all'orario di sparo.
+    """
+    if scheduler is None:
+        return
+    fire_at = booking_fire_time(booking_date)
+    run_at = max(fire_at - timedelta(seconds=BOOKING_PREP_LEAD), datetime.now(pytz.utc))
+    scheduler.add_job(
+        fire_booking,
+        'date',
+        run_date=run_at,
+        args=[booking_id, fire_at],
+        id=f'booking_{booking_id}',
+        replace_existing=True,
+        misfire_grace_time=None
+    )
+    preresolve_at = fire_at - timedelta(seconds=BOOKING_PRERESOLVE_LEAD)
+    if preresolve_at > datetime.now(pytz.utc):
+        scheduler.add_job(
+            preresolve_booking,
+            'date',
+            run_date=preresolve_at,
+            args=[booking_id],
+            id=f'preresolve_{booking_id}',
+            replace_existing=True,
+            misfire_grace_time=BOOKING_PRERESOLVE_LEAD
+        )
+    prewarm_at = fire_at - timedelta(seconds=BOOKING_PREWARM_LEAD)
+    if prewarm_at > datetime.now(pytz.utc):
+        # Un solo job per istante di sparo, condiviso dalle prenotazioni che scadono insieme
+        scheduler.add_job(
+            prewarm_connections,
+            'date',
+            run_date=prewarm_at,
+            id=f'prewarm_{int(fire_at.timestamp())}',
+            replace_existing=True,
+            misfire_grace_time=BOOKING_PREWARM_LEAD
+        )
+    with inflight_lock:
+        armed_bookings[booking_id] = fire_at
+    wake_sweep_by(fire_at)
+    logger.info(f"⏲️ Timer prenotazione #{booking_id} armato: {fire_at.astimezone(ROME_TZ).strftime('%d/%m/%Y %H:%M:%S')} (ora italiana)")
+
+
+def disarm_booking_timer(booking_id):
+    with inflight_lock:
+        fire_at = armed_bookings.pop(booking_id, None)
+    if scheduler is None:
+        return
+    if fire_at is not None and next_wake_at == booking_fire_time(fire_at) + timedelta(seconds=BOOKING_SWEEP_GRACE):
+        # Il prossimo controllo era per questa prenotazione
+        replan_sweep()
+    for job_id in (f'booking_{booking_id}', f'preresolve_{booking_id}'):
+        try:
+            scheduler.remove_job(job_id)
+        except JobLookupError:
+            pass
+    logger.info(f"⏲️ Timer prenotazione #{booking_id} rimosso")
+
+
+async def arm_pending_bookings():
+    """
+    Ricostruisce i timer dal job store scheduler_jobs (all'avvio e dopo una
+    riconnessione LISTEN): solo i job con l'orario di sparo ancora futuro,
+    comprese le prenotazioni aperte dentro le ore di silenzio e spostate alla
+    loro fine. Quelle già scadute le esegue il recupero all'avvio o il
+    controllo a scadenza.
+    """
+    try:
+        jobs = await async_db.fetch_future_booking_jobs()
+        for booking_id, booking_date in jobs:
+            arm_booking_timer(booking_id, booking_date)
+        logger.info(f"⏲️ Armati {len(jobs)} timer di prenotazione dal job store")
+    except Exception as e:
+        logger.error(f"❌ Errore arm_pending_bookings: {e}")
+
+
+async def prewarm_connections():
+    """Job: pre-apre le connessioni HTTP/TLS verso EasyFit pochi secondi prima di uno sparo"""
+    try:
+        await easyfit_async.prewarm(EASYFIT_PREWARM_CONNECTIONS)
+    except Exception as e:
+        logger.error(f"❌ Errore prewarm_connections: {e}")
+
+
+async def preresolve_booking(booking_id):
+    """
+    Ricontrolla il courseAppointmentId poco prima dell'apertura della
+    finestra (o lo risolve se manca), così allo sparo resta solo la POST.
+    """
+    try:
+        booking = await async_db.fetch_pending_booking(booking_id)
+        if not booking:
+            return
+        _, _, class_name, class_date, class_time, _, stored_id = booking
+        client = await easyfit_async.ensure()
+        if not client:
+            logger.warning(f"⚠️ Pre-risoluzione #{booking_id} saltata: login fallito")
+            return
+        course_appointment_id = await client.find_course_id(class_name, str(class_date), class_time)
+        if course_appointment_id and str(course_appointment_id) != str(stored_id):
+            await async_db.update_course_appointment_id(booking_id, course_appointment_id)
+            logger.info(f"🔁 Prenotazione #{booking_id}: ID lezione aggiornato {stored_id} → {course_appointment_id}")
+        elif course_appointment_id:
+            logger.info(f"✅ Prenotazione #{booking_id}: ID lezione {course_appointment_id} confermato")
+    except Exception as e:
+        logger.error(f"❌ Errore preresolve_booking #{booking_id}: {e}")
+
+
+async def fire_booking(booking_id, fire_at):
+    """
+    Job del timer: prende in carico la prenotazione e prepara la sessione,
+    poi prenota all'orario esatto e avvisa l'utente. La connessione DB non
+    resta occupata durante attesa e POST.
+    """
+    if not claim_local_booking(booking_id):
+        return
+    booking = None
+    writer = None
+    try:
+        booking = await async_db.claim_booking(booking_id)
+        if not booking:
+            logger.info(f"⏭️ Prenotazione #{booking_id} non più pending o presa da un'altra istanza, timer ignorato")
+            return
+        logger.info(f"📝 PRENOTAZIONE #{booking_id} (timer)")
+        logger.info(f"   📚 {booking[2]}")
+        logger.info(f"   📅 {booking[3]} ore {booking[4]}")
+        async with LeaseKeeper([booking_id]):
+            client = await easyfit_async.ensure()
+            if not client:
+                logger.error(f"❌ Login fallito - prenotazione #{booking_id} lasciata al controllo periodico")
+                return
+            course_appointment_id = await resolve_booking_course(client, booking, {})
+            outcome = await execute_booking(client, booking_id, course_appointment_id, fire_at)
+            writer = OutcomeWriter(bot_application, [booking])
+            await writer.add(outcome)
+            await writer.flush()
+    except Exception as e:
+        logger.error(f"❌ Errore fire_booking #{booking_id}: {e}")
+    finally:
+        settled = writer is not None and booking_id in writer.saved | writer.kept
+        if booking and not settled:
+            # Non eseguita: torna pending per il controllo periodico
+            try:
+                await async_db.release_booking_claims([booking_id])
+            except Exception as release_error:
+                logger.error(f"❌ Errore rilascio prenotazione #{booking_id}: {release_error}")
+        release_local_booking(booking_id)
+
+
+# =============================================================================
+# BOOKINGS LISTENER
+# =============================================================================
+
+def is_transaction_pooler(dsn):
+    """True se il DSN punta al pooler Supabase in transaction mode (niente LISTEN/NOTIFY)"""
+    try:
+        return psycopg2.extensions.parse_dsn(dsn).get('port') == SUPABASE_TRANSACTION_POOLER_PORT
+    except psycopg2.ProgrammingError:
+        # URL con parametri che libpq non conosce (es. ?pgbouncer=true)
+        return f":{SUPABASE_TRANSACTION_POOLER_PORT}/" in dsn or 'pgbouncer=true' in dsn
+
+
+class BookingListener:
+    """
+    Thread con una connessione dedicata in LISTEN su bookings_changed: i
+    timer seguono la coda appena cambia, senza interrogare il DB ogni minuto.
+    Se la connessione cade si riconnette con backoff e, una volta
+    riconnesso, chiama on_resync per recuperare le notifiche perse.
+    """
+
+    CHANNEL = 'bookings_changed'
+
+    def __init__(self, dsn, on_change, on_resync, poll_timeout=30):
+        self.dsn = dsn
+        self.on_change = on_change
+        self.on_resync = on_resync
+        self.poll_timeout = poll_timeout
+        # In transaction mode LISTEN riesce ma le notifiche non arrivano mai:
+        # lì il listener conta come sano solo dopo una notifica ricevuta
+        self.session_mode = not is_transaction_pooler(dsn)
+        self.connected = False
+        self.notifications = 0
+        self.reconnects = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='bookings-listener', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def healthy(self):
+        alive = self.connected and self._thread is not None and self._thread.is_alive()
+        return alive and (self.session_mode or self.notifications > 0)
+
+    def metrics(self):
+        return {
+            'connected': self.connected,
+            'session_mode': self.session_mode,
+            'notifications': self.notifications,
+            'reconnects': self.reconnects
+        }
+
+    def _listen(self):
+        conn = psycopg2.connect(
+            self.dsn, sslmode='require', connect_timeout=10,
+            keepalives=1, keepalives_idle=30, keepalives_interval=10, keepalives_count=3
+        )
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute(f"LISTEN {self.CHANNEL}")
+            self.connected = True
+            logger.info(f"👂 LISTEN {self.CHANNEL} attivo")
+            if self.reconnects:
+                self.on_resync()
+            while not self._stop.is_set():
+                if select.select([conn], [], [], self.poll_timeout) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    self.notifications += 1
+                    try:
+                        self.on_change(json.loads(notify.payload))
+                    except Exception as e:
+                        logger.error(f"❌ Errore notifica {notify.payload}: {e}")
+        finally:
+            self.connected = False
+            conn.close()
+
+    def _run(self):
+        backoff = 1
+        while not self._stop.is_set():
+            try:
+                self._listen()
+            except Exception as e:
+                logger.error(f"❌ LISTEN {self.CHANNEL} interrotto: {e}")
+            if self._stop.is_set():
+                break
+            self.reconnects += 1
+            logger.info(f"🔄 Riconnessione LISTEN tra {backoff}s...")
+            self._stop.wait(backoff)
+            backoff = min(backoff * 2, 60)
+
+
+# Listener globale (creato in post_init)
+booking_listener = None
+
+
+def resync_bookings():
+    """Dal thread del listener: riarma i timer con un job sull'event loop"""
+    if scheduler is not None:
+        scheduler.add_job(arm_pending_bookings, id='arm_pending', replace_existing=True)
+
+
+def handle_booking_change(change):
+    """
+    Notifica da bookings_changed: arma il timer delle prenotazioni nuove o
+    spostate, rimuove quello delle prenotazioni cancellate o prese in carico.
+    Le prenotazioni rimesse pending dopo un errore vengono riprese dal
+    controllo a scadenza dopo BOOKING_SWEEP_RETRY secondi.
+    """
+    if change.get('schema') != BOOKINGS_SCHEMA:
+        # Stesso database, altro schema (es. benchmark_db.py): non sono prenotazioni del bot
+        return
+    booking_id = change.get('id')
+    status = change.get('status')
+    if status == 'pending' and change.get('old_status') == 'in_progress':
+        schedule_sweep(datetime.now(pytz.utc) + timedelta(seconds=BOOKING_SWEEP_RETRY), only_earlier=True)
+    elif status == 'pending' and change.get('old_status') in (None, 'pending'):
+        booking_date = datetime.fromisoformat(change['booking_date'])
+        if armed_bookings.get(booking_id) == booking_fire_time(booking_date):
+            return
+        arm_booking_timer(booking_id, booking_date)
+    elif status != 'pending' and booking_id in armed_bookings:
+        disarm_booking_timer(booking_id)
+
+
+# =============================================================================
+# NEXT-DUE SWEEP
+# =============================================================================
+
+# Prossimo risveglio programmato (UTC), risvegli fatti e risvegli al minuto evitati
+next_wake_at = None
+sweep_wakeups = 0
+wakeups_saved = 0
+last_wake_at = None
+sweep_lock = Lock()
+
 
-    class_datetime_naive = datetime.strptime(
-        f"{context.user_data['date']} {time_str}",
-        '%Y-%m-%d %H:%M'
-    )
-    class_datetime_rome = ROME_TZ.localize(class_datetime_naive)
-    booking_datetime_rome = class_datetime_rome - timedelta(hours=72)
-    booking_datetime_utc = booking_datetime_rome.astimezone(pytz.utc)
+def sweep_wake_time(due_at, now):
+    """Risveglio per una scadenza: poco dopo il suo orario di sparo, mai nel passato"""
+    wake_at = booking_fire_time(due_at) + timedelta(seconds=BOOKING_SWEEP_GRACE)
+    return max(wake_at, now + timedelta(seconds=1))
 
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO bookings 
-            (user_id, class_name, class_date, class_time, booking_date, status)
-            VALUES (%s, %s, %s, %s, %s, %s)
-            RETURNING id
-            """,
-            (
-                str(query.from_user.id),
-                context.user_data['class_name'],
-                context.user_data['date'],
-                time_str,
-                booking_datetime_utc,
-                'pending'
-            )
-        )
-        booking_id = cur.fetchone()[0]
-        conn.commit()
-        cur.close()
-        release_db_connection(conn)
-        date_obj = datetime.strptime(context.user_data['date'], '%Y-%m-%d')
-        day_name = ['Lunedì', 'Martedì', 'Mercoledì', 'Giovedì', 'Venerdì', 'Sabato', 'Domenica'][date_obj.weekday()]
-        await query.edit_message_text(
-            f"✅ PRENOTAZIONE PROGRAMMATA!\n\n"
-            f"📚 Lezione: {context.user_data['class_name']}\n"
-            f"📅 Data: {day_name} {date_obj.strftime('%d/%m/%Y')}\n"
-            f"🕐 Orario: {time_str}\n\n"
-            f"⏰ Prenoterò automaticamente:\n"
-            f"   {booking_datetime_rome.strftime('%d/%m/%Y alle %H:%M')} (ora italiana)\n"
-            f"   (72 ore prima)\n\n"
-            f"Usa /lista per verificare!\n\n"
-            f"ID Prenotazione: #{booking_id}"
-        )
-    except Exception as e:
-        logger.error(f"Errore salvataggio database: {e}")
-        await query.edit_message_text(
-            "❌ Errore nel salvare la prenotazione. Riprova."
+
+def schedule_sweep(wake_at, only_earlier=False):
+    """Programma il controllo prenotazioni a wake_at (con only_earlier solo se anticipa)"""
+    global next_wake_at
+    if scheduler is None:
+        return
+    with sweep_lock:
+        if only_earlier and next_wake_at is not None and next_wake_at <= wake_at:
+            return
+        next_wake_at = wake_at
+        scheduler.add_job(
+            run_sweep,
+            'date',
+            run_date=wake_at,
+            id='check_bookings',
+            replace_existing=True,
+            misfire_grace_time=None
         )
+    logger.info(f"😴 Prossimo controllo prenotazioni: {wake_at.astimezone(ROME_TZ).strftime('%d/%m/%Y %H:%M:%S')} (ora italiana)")
 
 
-async def lista(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.effective_user.id)
+def wake_sweep_by(due_at):
+    """Anticipa il controllo per una prenotazione appena armata"""
+    schedule_sweep(sweep_wake_time(due_at, datetime.now(pytz.utc)), only_earlier=True)
+
+
+def next_sweep_time(due_at, now):
+    """
+    Prossimo risveglio per la scadenza due_at. Senza LISTEN attivo non dorme
+    più di BOOKING_SWEEP_POLL secondi (polling di riserva).
+    """
+    listening = booking_listener is not None and booking_listener.healthy()
+    ceiling = now + timedelta(seconds=BOOKING_SWEEP_MAX_SLEEP if listening else BOOKING_SWEEP_POLL)
+    if due_at is None:
+        wake_at = ceiling
+    elif due_at <= now:
+        # Ancora righe scadute (in esecuzione altrove o rimesse pending dopo un errore):
+        # si riprova tra poco, ma nelle ore di silenzio solo alla loro fine
+        wake_at = max(now + timedelta(seconds=BOOKING_SWEEP_RETRY), sweep_wake_time(now, now))
+    else:
+        wake_at = min(sweep_wake_time(due_at, now), ceiling)
+    return wake_at
+
+
+async def fetch_sweep_due(now):
+    """Prossima scadenza dal DB; se la query fallisce riprogramma il controllo e ritorna False"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT id, class_name, class_date, class_time, booking_date, status
-            FROM bookings
-            WHERE user_id = %s
-            ORDER BY class_date, class_time
-            """,
-            (user_id,)
-        )
-        bookings = cur.fetchall()
-        cur.close()
-        release_db_connection(conn)
-        if not bookings:
-            await update.message.reply_text(
-                "📋 Non hai prenotazioni.\n\n"
-                "Usa /prenota per programmarne una!"
-            )
-            return
-        from datetime import timezone
-        now_utc = datetime.now(timezone.utc)
-        future_bookings = []
-        for booking in bookings:
-            booking_id, class_name, class_date, class_time, booking_date, status = booking
-            class_datetime_naive = datetime.strptime(f"{class_date} {class_time}", '%Y-%m-%d %H:%M')
-            class_datetime_rome = ROME_TZ.localize(class_datetime_naive)
-            class_datetime_utc = class_datetime_rome.astimezone(pytz.utc)
-            if class_datetime_utc > now_utc:
-                future_bookings.append(booking)
-        if not future_bookings:
-            await update.message.reply_text(
-                "📋 Non hai prenotazioni future.\n\n"
-                "Usa /prenota per programmarne una!"
-            )
-            return
-        message = "📋 LE TUE PRENOTAZIONI:\n\n"
-        pending = []
-        completed = []
-        waitlisted = []
-        for booking in future_bookings:
-            booking_id, class_name, class_date, class_time, booking_date, status = booking
-            if status == 'pending':
-                pending.append(booking)
-            elif status == 'completed':
-                completed.append(booking)
-            elif status == 'waitlisted':
-                waitlisted.append(booking)
-        if pending:
-            message += "⏳ PROGRAMMATE:\n"
-            for booking in pending:
-                booking_id, class_name, class_date, class_time, booking_date, status = booking
-                date_obj = datetime.strptime(str(class_date), '%Y-%m-%d')
-                day_name = ['Lun', 'Mar', 'Mer', 'Gio', 'Ven', 'Sab', 'Dom'][date_obj.weekday()]
-                if booking_date.tzinfo is None:
-                    booking_date = booking_date.replace(tzinfo=pytz.utc)
-                booking_date_ita = booking_date.astimezone(ROME_TZ)
-                message += f"#{booking_id} - {class_name}\n"
-                message += f"   📅 {day_name} {date_obj.strftime('%d/%m/%Y')} ore {class_time}\n"
-                message += f"   ⏰ Prenoterò: {booking_date_ita.strftime('%d/%m/%Y %H:%M')} (ora italiana)\n\n"
-        if completed:
-            message += "✅ PRENOTATE:\n"
-            for booking in completed:
-                booking_id, class_name, class_date, class_time, booking_date, status = booking
-                date_obj = datetime.strptime(str(class_date), '%Y-%m-%d')
-                day_name = ['Lun', 'Mar', 'Mer', 'Gio', 'Ven', 'Sab', 'Dom'][date_obj.weekday()]
-                message += f"#{booking_id} - {class_name}\n"
-                message += f"   📅 {day_name} {date_obj.strftime('%d/%m/%Y')} ore {class_time}\n\n"
-        if waitlisted:
-            message += "📋 LISTA D'ATTESA:\n"
-            for booking in waitlisted:
-                booking_id, class_name, class_date, class_time, booking_date, status = booking
-                date_obj = datetime.strptime(str(class_date), '%Y-%m-%d')
-                day_name = ['Lun', 'Mar', 'Mer', 'Gio', 'Ven', 'Sab', 'Dom'][date_obj.weekday()]
-                message += f"#{booking_id} - {class_name}\n"
-                message += f"   📅 {day_name} {date_obj.strftime('%d/%m/%Y')} ore {class_time}\n\n"
-        message += "💡 Usa /cancella <ID> per cancellare"
-        await update.message.reply_text(message)
+        return await async_db.fetch_next_due()
     except Exception as e:
-        logger.error(f"Errore recupero prenotazioni: {e}")
-        await update.message.reply_text("❌ Errore nel recuperare le prenotazioni.")
+        logger.error(f"❌ Errore calcolo prossima scadenza: {e}")
+        schedule_sweep(now + timedelta(seconds=BOOKING_SWEEP_RETRY))
+        return False
 
 
-async def cancella(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    user_id = str(update.effective_user.id)
-    if not context.args:
-        await update.message.reply_text(
-            "❌ Devi specificare l'ID della prenotazione.\n\n"
-            "Esempio: /cancella 5\n\n"
-            "Usa /lista per vedere gli ID."
-        )
+async def plan_next_sweep():
+    """Ricalcola dal DB la prossima scadenza e programma lì il controllo"""
+    now = datetime.now(pytz.utc)
+    due_at = await fetch_sweep_due(now)
+    if due_at is not False:
+        schedule_sweep(next_sweep_time(due_at, now))
+
+
+def replan_sweep():
+    """Ricalcola il prossimo risveglio con un job dello scheduler (chiamabile da qualsiasi thread)"""
+    if scheduler is not None:
+        scheduler.add_job(plan_next_sweep, id='sweep_replan', replace_existing=True)
+
+
+async def run_sweep():
+    """
+    Job del controllo prenotazioni: esegue check_and_book solo se qualcosa è
+    scaduto, altrimenti si riprogramma con la sola query della prossima scadenza.
+    """
+    global sweep_wakeups, wakeups_saved, last_wake_at
+    now = datetime.now(pytz.utc)
+    if last_wake_at is not None:
+        wakeups_saved += max(0, int((now - last_wake_at).total_seconds() // 60) - 1)
+    last_wake_at = now
+    sweep_wakeups += 1
+    due_at = await fetch_sweep_due(now)
+    if due_at is False:
         return
-    try:
-        booking_id = int(context.args[0])
-    except ValueError:
-        await update.message.reply_text("❌ ID non valido. Deve essere un numero.")
+    if due_at is None or due_at > now or in_quiet_hours(now.astimezone(ROME_TZ).hour):
+        schedule_sweep(next_sweep_time(due_at, now))
         return
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            "SELECT class_name, class_date, class_time, status, easyfit_booking_id FROM bookings WHERE id = %s AND user_id = %s",
-            (booking_id, user_id)
-        )
-        result = cur.fetchone()
-        if not result:
-            await update.message.reply_text(f"❌ Prenotazione #{booking_id} non trovata.")
-            cur.close()
-            release_db_connection(conn)
-            return
-        class_name, class_date, class_time, status, easyfit_booking_id = result
-        if status == 'pending':
-            cur.execute("DELETE FROM bookings WHERE id = %s", (booking_id,))
-            conn.commit()
-            cur.close()
-            release_db_connection(conn)
-            await update.message.reply_text(
-                f"✅ PRENOTAZIONE PROGRAMMATA CANCELLATA\n\n"
-                f"#{booking_id} - {class_name}\n"
-                f"📅 {class_date} ore {class_time}\n\n"
-                f"ℹ️ La prenotazione non era ancora stata eseguita.\n"
-                f"Rimossa solo dal database del bot."
-            )
-            return
-        if status in ['completed', 'waitlisted']:
-            if not easyfit_booking_id:
-                await update.message.reply_text(
-                    f"⚠️ CANCELLAZIONE PARZIALE\n\n"
-                    f"#{booking_id} - {class_name}\n"
-                    f"📅 {class_date} ore {class_time}\n\n"
-                    f"❌ Non ho l'ID della prenotazione su EasyFit.\n"
-                    f"Cancellata solo dal bot.\n\n"
-                    f"⚠️ Devi cancellare manualmente dall'app EasyFit!"
-                )
-                cur.execute("DELETE FROM bookings WHERE id = %s", (booking_id,))
-                conn.commit()
-                cur.close()
-                release_db_connection(conn)
-                return
-            await update.message.reply_text("🔄 Cancellazione in corso...\n⏳ Attendi...")
-            session = easyfit_login()
-            if not session:
-                await update.message.reply_text(
-                    f"❌ ERRORE LOGIN EASYFIT\n\n"
-                    f"Non riesco a connettermi a EasyFit.\n\n"
-                    f"💡 Prova:\n"
-                    f"1. Cancella manualmente dall'app\n"
-                    f"2. Riprova tra qualche minuto"
-                )
-                cur.close()
-                release_db_connection(conn)
-                return
-            success = cancel_booking_easyfit(session, easyfit_booking_id)
-            if success:
-                cur.execute("DELETE FROM bookings WHERE id = %s", (booking_id,))
-                conn.commit()
-                await update.message.reply_text(
-                    f"✅ PRENOTAZIONE CANCELLATA!\n\n"
-                    f"#{booking_id} - {class_name}\n"
-                    f"📅 {class_date} ore {class_time}\n\n"
-                    f"✅ Cancellata su EasyFit\n"
-                    f"✅ Rimossa dal bot\n\n"
-                    f"Il posto è ora disponibile per altri!"
-                )
-            else:
-                await update.message.reply_text(
-                    f"⚠️ CANCELLAZIONE FALLITA\n\n"
-                    f"#{booking_id} - {class_name}\n"
-                    f"📅 {class_date} ore {class_time}\n\n"
-                    f"❌ Errore nella cancellazione su EasyFit.\n\n"
-                    f"💡 Prova a cancellare manualmente dall'app.\n"
-                    f"La prenotazione rimane nel database del bot."
-                )
-            cur.close()
-            release_db_connection(conn)
-            return
-        await update.message.reply_text(
-            f"⚠️ Status prenotazione sconosciuto: {status}\n"
-            f"Contatta l'amministratore."
-        )
-        cur.close()
-        release_db_connection(conn)
-    except Exception as e:
-        logger.error(f"Errore cancellazione: {e}")
-        await update.message.reply_text("❌ Errore nella cancellazione.")
+        await check_and_book(bot_application)
+    finally:
+        await plan_next_sweep()
 
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(
-        "📖 GUIDA EASYFIT BOT\n\n"
-        "🤖 Cosa fa questo bot:\n"
-        "Prenota automaticamente le tue lezioni EasyFit "
-        "esattamente 72 ore prima dell'inizio.\n\n"
-        "📋 COMANDI:\n\n"
-        "/prenota - Programma una nuova prenotazione\n"
-        "   Mostra calendario REALE EasyFit.\n"
-        "   Scegli lezione, giorno e orario.\n"
-        "   Il bot prenoterà automaticamente 72h prima.\n\n"
-        "/lista - Vedi tutte le prenotazioni\n"
-        "   Mostra cosa hai in programma.\n\n"
-        "/cancella <ID> - Cancella una prenotazione\n"
-        "   Esempio: /cancella 5\n"
-        "   ⚠️ Se già prenotata, cancella anche su EasyFit!\n\n"
-        "⏰ ORARI:\n"
-        "Il bot è attivo dalle 8:00 alle 21:00 ogni giorno.\n"
-        "Controlla ogni minuto se ci sono prenotazioni da fare.\n\n"
-        "📋 LISTA D'ATTESA:\n"
-        "Se una lezione è piena, il bot proverà automaticamente\n"
-        "ad inserirti in lista d'attesa!\n\n"
-        "❓ Problemi? Usa /lista per controllare lo stato."
-    )
+async def start_sweep():
+    await plan_next_sweep()
 
 
 # =============================================================================
-# SCHEDULER FUNCTION
+# STARTUP CATCH-UP
 # =============================================================================
 
-def check_and_book(application):
+# Prenotazioni recuperate all'avvio e ritardo massimo rispetto allo sparo ideale (secondi)
+catch_up_bookings = 0
+catch_up_max_late_s = None
+
+
+async def catch_up_overdue_bookings():
     """
-    Controlla e prenota lezioni.
-    Viene chiamato dallo scheduler già filtrato per orario 8-21 Europe/Rome,
-    quindi non serve un controllo orario interno.
+    Recupero all'avvio: le prenotazioni pending scadute mentre il bot era
+    fermo vengono prese tutte, in ordine di inizio lezione e di ritardo, ed
+    eseguite subito sul percorso concorrente a gruppi di BOOKING_CONCURRENCY,
+    prima del normale controllo a scadenza. Logga il ritardo di ognuna.
     """
-    from datetime import timezone
-    now_utc = datetime.now(timezone.utc)
+    global catch_up_bookings, catch_up_max_late_s
+    now = datetime.now(pytz.utc)
+    if in_quiet_hours(now.astimezone(ROME_TZ).hour):
+        logger.info("🌙 Ore di silenzio: recupero delle prenotazioni scadute rimandato")
+        return
+    done = set()
+    try:
+        for booking_id, lease_owner in await async_db.recover_expired_leases():
+            logger.warning(f"♻️ Prenotazione #{booking_id}: lease di {lease_owner} scaduto, torna pending")
+        while True:
+            with inflight_lock:
+                local_ids = set(armed_bookings) | inflight_bookings
+            bookings = await async_db.claim_overdue_bookings(now, done | local_ids)
+            if not bookings:
+                break
+            for booking_id, _, class_name, class_date, class_time, booking_date, _ in bookings:
+                late_s = (now - booking_fire_time(booking_date)).total_seconds()
+                catch_up_max_late_s = max(late_s, catch_up_max_late_s or 0)
+                logger.warning(
+                    f"🚑 Recupero #{booking_id}: {class_name} {class_date} ore {class_time}, "
+                    f"in ritardo di {late_s / 60:.1f} minuti sullo sparo ideale"
+                )
+            done |= {booking[0] for booking in bookings}
+            catch_up_bookings += len(bookings)
+            await book_claimed_bookings(bot_application, bookings, now)
+    except Exception as e:
+        logger.error(f"❌ Errore recupero prenotazioni scadute: {e}")
+    if done:
+        logger.info(f"🚑 Recupero completato: {len(done)} prenotazioni (ritardo max {catch_up_max_late_s / 60:.1f} minuti)")
+    else:
+        logger.info("✅ Nessuna prenotazione scaduta da recuperare")
+
+
+# =============================================================================
+# BOOKINGS ARCHIVE
+# =============================================================================
+
+# Righe spostate in bookings_history da questo processo e ultima esecuzione del job
+archived_total = 0
+last_archive_at = None
 
-    logger.info(f"🔍 CONTROLLO PRENOTAZIONI")
-    logger.info(f"⏰ Ora UTC: {now_utc.strftime('%Y-%m-%d %H:%M:%S')}")
-    logger.info(f"⏰ Ora ITA: {now_utc.astimezone(ROME_TZ).strftime('%Y-%m-%d %H:%M:%S')}")
 
+async def archive_bookings():
+    """
+    Job notturno: sposta in bookings_history le prenotazioni di lezioni
+    passate, a batch di BOOKING_ARCHIVE_BATCH_SIZE righe per transazione,
+    così bookings contiene solo righe vive.
+    """
+    global archived_total, last_archive_at
+    moved = 0
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute(
-            """
-            SELECT id, user_id, class_name, class_date, class_time, booking_date
-            FROM bookings
-            WHERE status = 'pending'
-            AND booking_date <= %s
-            ORDER BY booking_date ASC
-            """,
-            (now_utc,)
-        )
-        bookings_to_make = cur.fetchall()
-        logger.info(f"📋 Trovate {len(bookings_to_make)} prenotazioni da processare")
-        if not bookings_to_make:
-            release_db_connection(conn)
-            return
-        session = easyfit_login()
-        if not session:
-            logger.error("❌ Login fallito - salto controllo")
-            cur.close()
-            release_db_connection(conn)
-            return
-        for booking in bookings_to_make:
-            booking_id, user_id, class_name, class_date, class_time, booking_date = booking
-            logger.info(f"📝 PRENOTAZIONE #{booking_id}")
-            logger.info(f"   📚 {class_name}")
-            logger.info(f"   📅 {class_date} ore {class_time}")
-            delay = (now_utc - booking_date.replace(tzinfo=timezone.utc)).total_seconds() / 60
-            if delay > 5:
-                logger.warning(f"   ⚠️ In ritardo di {int(delay)} minuti")
-            try:
-                course_appointment_id = find_course_id(session, class_name, str(class_date), class_time)
-                if not course_appointment_id:
-                    cur.execute(
-                        "UPDATE bookings SET status = 'completed' WHERE id = %s",
-                        (booking_id,)
-                    )
-                    conn.commit()
-                    logger.warning(f"⚠️ Prenotazione #{booking_id} - Lezione non trovata")
-                    continue
-                success, status, response = book_course_easyfit(session, course_appointment_id)
-                if success:
-                    easyfit_booking_id = None
-                    if response and isinstance(response, dict):
-                        easyfit_booking_id = response.get('id')
-                    cur.execute(
-                        "UPDATE bookings SET status = %s, easyfit_booking_id = %s WHERE id = %s",
-                        (status, easyfit_booking_id, booking_id)
-                    )
-                    conn.commit()
-                    logger.info(f"💾 Salvato easyfit_booking_id: {easyfit_booking_id}")
-                    logger.info(f"🎉 Prenotazione #{booking_id} completata - Status: {status}")
-                else:
-                    logger.error(f"❌ Prenotazione #{booking_id} fallita - Status: {status}")
-                    cur.execute(
-                        "UPDATE bookings SET status = 'completed' WHERE id = %s",
-                        (booking_id,)
-                    )
-                    conn.commit()
-            except Exception as booking_error:
-                logger.error(f"❌ Errore processamento prenotazione #{booking_id}: {booking_error}")
-                continue
-        cur.close()
-        release_db_connection(conn)
-    except psycopg2.OperationalError as db_error:
-        logger.error(f"❌ Errore connessione DB: {db_error}")
-        logger.info("⏭️ Salto questo controllo, riproverò al prossimo minuto")
+        for _ in range(BOOKING_ARCHIVE_MAX_BATCHES):
+            batch = await async_db.archive_past_bookings()
+            moved += batch
+            if batch < BOOKING_ARCHIVE_BATCH_SIZE:
+                break
+        if moved:
+            logger.info(f"🗄️ Archiviate {moved} prenotazioni in bookings_history")
     except Exception as e:
-        logger.error(f"❌ Errore check_and_book: {e}")
-        import traceback
-        logger.error(traceback.format_exc())
+        logger.error(f"❌ Errore archiviazione prenotazioni: {e}")
+    finally:
+        archived_total += moved
+        last_archive_at = datetime.now(pytz.utc)
 
 
 # =============================================================================
 # HEALTH CHECK SERVER
 # =============================================================================
 
+def collect_metrics():
+    """Metriche del bot esposte su /metrics"""
+    offsets = list(fire_offsets_ms)
+    return {
+        'easyfit_connections': easyfit_async.connection_metrics(),
+        'booking_fire_offsets_ms': {
+            'count': len(offsets),
+            'last': round(offsets[-1], 1) if offsets else None,
+            'max': round(max(offsets), 1) if offsets else None
+        },
+        'armed_bookings': len(armed_bookings),
+        'bookings_listener': booking_listener.metrics() if booking_listener else None,
+        'sweep': {
+            'next_wake_at': next_wake_at.isoformat() if next_wake_at else None,
+            'wakeups': sweep_wakeups,
+            'wakeups_saved': wakeups_saved
+        },
+        'db_pool': async_db.metrics(),
+        'calendar_cache': {'hits': calendar_cache.hits, 'misses': calendar_cache.misses},
+        'catch_up': {
+            'bookings': catch_up_bookings,
+            'max_late_s': round(catch_up_max_late_s, 1) if catch_up_max_late_s is not None else None
+        },
+        'archive': {
+            'archived_total': archived_total,
+            'last_run_at': last_archive_at.isoformat() if last_archive_at else None
+        }
+    }
+
+
 class HealthCheckHandler(BaseHTTPRequestHandler):
     def do_GET(self):
+        if self.path == '/metrics':
+            try:
+                body = json.dumps(collect_metrics()).encode()
+            except Exception as e:
+                logger.error(f"❌ Errore metriche: {e}")
+                body = b'{}'
+            self.send_response(200)
+            self.send_header('Content-type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
         self.send_response(200)
         self.send_header('Content-type', 'text/plain')
         self.send_header('Content-Length', '2')
@@ -946,6 +3201,60 @@ def keep_alive_ping():
 # MAIN
 # =============================================================================
 
+async def post_init(application):
+    """
+    Avvio sull'event loop del bot: migrazioni, scheduler asincrono, timer
+    di prenotazione, listener e controllo a scadenza. Così prenotazioni,
+    scritture DB e notifiche condividono lo stesso loop e gli stessi pool.
+    """
+    global scheduler, booking_listener, bot_application
+    bot_application = application
+    await run_migrations()
+
+    scheduler = AsyncIOScheduler()
+
+    scheduler.add_job(
+        archive_bookings,
+        'cron',
+        hour=3,
+        minute=30,
+        timezone='Europe/Rome',
+        id='archive_bookings'
+    )
+
+    # Sincrono: l'executor dello scheduler lo esegue in un thread
+    scheduler.add_job(
+        keep_alive_ping,
+        'cron',
+        minute='*/10',
+        id='keep_alive'
+    )
+
+    scheduler.start()
+    # Recupero delle prenotazioni scadute a bot fermo: parte subito, senza ritardare il polling
+    scheduler.add_job(catch_up_overdue_bookings, id='catch_up')
+    await arm_pending_bookings()
+
+    if DATABASE_LISTEN_URL:
+        booking_listener = BookingListener(DATABASE_LISTEN_URL, handle_booking_change, resync_bookings)
+        if not booking_listener.session_mode:
+            logger.warning(
+                "⚠️ DATABASE_LISTEN_URL punta al pooler in transaction mode: le notifiche "
+                f"probabilmente non arriveranno, il controllo resta a polling ogni {BOOKING_SWEEP_POLL}s"
+            )
+        booking_listener.start()
+    await start_sweep()
+
+
+async def post_shutdown(application):
+    if booking_listener is not None:
+        booking_listener.stop()
+    if scheduler is not None and scheduler.running:
+        scheduler.shutdown(wait=False)
+    await easyfit_async.aclose()
+    async_db.close()
+
+
 def main():
     from datetime import timezone
     startup_time = datetime.now(timezone.utc)
@@ -957,46 +3266,35 @@ def main():
     logger.info(f"⏰ Ora ITA: {startup_time_ita.strftime('%Y-%m-%d %H:%M:%S')} ({startup_time_ita.tzname()})")
     logger.info("=" * 60)
 
-    init_db_pool()
-
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+    application = (
+        Application.builder()
+        .token(TELEGRAM_TOKEN)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("prenota", prenota))
     application.add_handler(CommandHandler("lista", lista))
+    application.add_handler(CommandHandler("storico", storico))
     application.add_handler(CommandHandler("cancella", cancella))
     application.add_handler(CommandHandler("help", help_command))
 
     application.add_handler(CallbackQueryHandler(class_selected, pattern="^type_"))
     application.add_handler(CallbackQueryHandler(date_selected, pattern="^date_"))
     application.add_handler(CallbackQueryHandler(time_selected, pattern="^time_"))
+    application.add_handler(CallbackQueryHandler(lista_page, pattern="^lista_"))
 
     health_thread = threading.Thread(target=run_health_server, daemon=True)
     health_thread.start()
 
-    scheduler = BackgroundScheduler()
-
-    scheduler.add_job(
-        lambda: check_and_book(application),
-        'cron',
-        hour='8-21',
-        minute='*',
-        timezone='Europe/Rome',
-        id='check_bookings'
-    )
-
-    scheduler.add_job(
-        keep_alive_ping,
-        'cron',
-        minute='*/10',
-        id='keep_alive'
-    )
-
-    scheduler.start()
-
     logger.info("=" * 60)
     logger.info("✅ BOT PRONTO E OPERATIVO!")
-    logger.info("⏰ Attivo 8-21 ora italiana (Europe/Rome)")
+    if QUIET_HOURS:
+        logger.info(f"⏰ Prenotazioni a qualsiasi ora, silenzio {QUIET_HOURS} ora italiana (Europe/Rome)")
+    else:
+        logger.info("⏰ Prenotazioni a qualsiasi ora, all'apertura esatta")
     logger.info("💓 Keep-alive attivo 24/7")
     logger.info("📱 Comandi disponibili su Telegram")
     logger.info("=" * 60)
@@ -1011,7 +3309,10 @@ def main():
         from datetime import timezone
         logger.warning(f"⏰ Ora UTC: {datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')}")
         logger.warning("=" * 60)
-        scheduler.shutdown()
+        if booking_listener is not None:
+            booking_listener.stop()
+        if scheduler is not None and scheduler.running:
+            scheduler.shutdown(wait=False)
         sys.exit(0)
 
     signal.signal(signal.SIGTERM, shutdown_handler)